@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""Benchmarks for the snapshot runner, normalizers and comparators.
+
+Generates synthetic output trees in a temporary directory and times the hot
+paths in-process. Nothing is downloaded, so it runs offline:
+
+    bazel run //bench -- --output=/tmp/bench.json
+    bazel run //bench -- --baseline=/tmp/bench.json
+    bazel run //bench -- --jobs=4 --filter=process_outputs
+
+The JSON report records the median and minimum of several runs per
+benchmark; passing an earlier report as --baseline adds a change column to
+the summary table.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from compare import binary as binary_compare
+from compare import json_diff as json_compare
+from compare import text as text_compare
+from snapshot.private import runner_main
+from snapshot.private import text_normalizer
+
+_MIB = 1024 * 1024
+_WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel"]
+
+
+class _TreeRunfiles:
+    """Resolves runfiles against a directory, like a runfiles tree."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def Rlocation(self, path):  # pylint: disable=invalid-name
+        return os.path.join(self.root, path)
+
+
+def _text_line(rng, index):
+    words = " ".join(rng.choice(_WORDS) for _ in range(8))
+    return "{:08d} 2024-01-{:02d}T12:00:00 {}\n".format(index, index % 28 + 1, words)
+
+
+def _write_text(path, rng, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    written = 0
+    index = 0
+    with open(path, "w", encoding="utf-8", newline="") as handle:
+        while written < size:
+            lines = "".join(_text_line(rng, index + offset) for offset in range(1000))
+            handle.write(lines)
+            written += len(lines)
+            index += 1000
+    return written
+
+
+def _write_binary(path, rng, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as handle:
+        handle.write(rng.randbytes(size))
+    return size
+
+
+def _mutate(path, offset_fraction=0.5):
+    """Flips one byte in the middle of `path`, keeping its size."""
+    with open(path, "r+b") as handle:
+        handle.seek(0, os.SEEK_END)
+        offset = int(handle.tell() * offset_fraction)
+        handle.seek(offset)
+        byte = handle.read(1)
+        handle.seek(offset)
+        handle.write(bytes([byte[0] ^ 0x01]) if byte and byte != b"\n" else b"#")
+
+
+def generate_trees(root, scale):
+    """Writes the synthetic output trees; returns {name: (directory, total_bytes)}."""
+    rng = random.Random(20240101)
+    trees = {}
+
+    many_small = os.path.join(root, "many_small")
+    total = 0
+    for index in range(int(2000 * scale) or 1):
+        path = os.path.join(many_small, "group{:02d}".format(index % 40), "file{:05d}.txt".format(index))
+        total += _write_text(path, rng, 1024)
+    trees["many_small"] = (many_small, total)
+
+    few_huge = os.path.join(root, "few_huge")
+    total = 0
+    for index in range(2):
+        total += _write_text(os.path.join(few_huge, "huge{}.txt".format(index)), rng, int(64 * _MIB * scale))
+    trees["few_huge"] = (few_huge, total)
+
+    deep = os.path.join(root, "deep_dirs")
+    total = 0
+    for index in range(int(500 * scale) or 1):
+        parts = ["level{}".format(depth) for depth in range(index % 24)]
+        total += _write_text(os.path.join(deep, *parts, "file{:04d}.txt".format(index)), rng, 512)
+    trees["deep_dirs"] = (deep, total)
+
+    blobs = os.path.join(root, "binary_blobs")
+    total = 0
+    for index in range(16):
+        total += _write_binary(os.path.join(blobs, "blob{:02d}.bin".format(index)), rng, int(8 * _MIB * scale))
+    trees["binary_blobs"] = (blobs, total)
+    return trees
+
+
+def _json_document(rng, count):
+    return [
+        {
+            "id": index,
+            "name": rng.choice(_WORDS),
+            "value": rng.random(),
+            "tags": [rng.choice(_WORDS) for _ in range(3)],
+            "enabled": index % 2 == 0,
+        }
+        for index in range(count)
+    ]
+
+
+def _call(func, argv):
+    return func(argv, io.StringIO(), io.StringIO())
+
+
+def _format_cfg(display_name, pattern, normalize, compare):
+    return {"display_name": display_name, "patterns": [pattern], "normalize": normalize, "compare": compare}
+
+
+def _builtin_spec(label, builtin, args):
+    return {
+        "label": label,
+        "executable": label,
+        "args": args,
+        "env": {},
+        "stdout": False,
+        "streaming": True,
+        "builtin": builtin,
+        "worker": False,
+    }
+
+
+_REDACT = _builtin_spec(
+    "//snapshot/private:text_normalizer",
+    "text_normalizer",
+    ["{INPUT}", "{OUTPUT}", "--replace-text", r"\d{4}-\d\d-\d\dT[\d:]+", "REDACTED"],
+)
+_TEXT_COMPARE = _builtin_spec("//compare:text", "text_compare", ["{SNAPSHOT}", "{OUTPUT}"])
+_BINARY_COMPARE = _builtin_spec("//compare:binary", "binary_compare", ["{SNAPSHOT}", "{OUTPUT}"])
+
+
+def prepare_runner_case(work, name, tree_dir, formats, jobs=0):
+    """Creates snapshots matching `tree_dir` after normalization; returns a process_outputs closure."""
+    runfiles_root = os.path.join(work, "runfiles_" + name)
+    snapshot_prefix = "_main/snapshots/" + name
+    snapshot_dir = os.path.join(runfiles_root, snapshot_prefix)
+    config = {"formats": formats, "snapshot_prefix": snapshot_prefix, "jobs": jobs}
+    runfiles_ctx = _TreeRunfiles(runfiles_root)
+    output_root = os.path.join(work, "outputs_" + name)
+
+    def run():
+        shutil.rmtree(output_root, ignore_errors=True)
+        normalized_dir = os.path.join(output_root, "normalized")
+        results_dir = os.path.join(output_root, "results")
+        os.makedirs(normalized_dir)
+        os.makedirs(results_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return runner_main.process_outputs(runfiles_ctx, config, tree_dir, normalized_dir, results_dir)
+
+    # Accept once to produce the snapshots, then every timed run passes.
+    shutil.rmtree(output_root, ignore_errors=True)
+    os.makedirs(os.path.join(output_root, "normalized"))
+    os.makedirs(os.path.join(output_root, "results"))
+    runner_main.process_outputs(
+        runfiles_ctx,
+        config,
+        tree_dir,
+        os.path.join(output_root, "normalized"),
+        os.path.join(output_root, "results"),
+        accept=True,
+    )
+    shutil.copytree(os.path.join(output_root, "normalized"), snapshot_dir)
+    return run
+
+
+def build_benchmarks(work, trees, scale, jobs=0):
+    """Returns a list of (name, bytes_processed, callable)."""
+    benchmarks = []
+    text_formats = [_format_cfg("text", "**/*.txt", [_REDACT], _TEXT_COMPARE)]
+    binary_formats = [_format_cfg("binary", "**/*.bin", [], _BINARY_COMPARE)]
+
+    for tree_name, (tree_dir, size) in sorted(trees.items()):
+        formats = binary_formats if tree_name == "binary_blobs" else text_formats
+        benchmarks.append(
+            (
+                "assign_formats/" + tree_name,
+                0,
+                lambda tree_dir=tree_dir, formats=formats: runner_main.assign_formats(tree_dir, formats),
+            )
+        )
+        benchmarks.append(
+            (
+                "process_outputs/" + tree_name,
+                size,
+                prepare_runner_case(work, tree_name, tree_dir, formats, jobs),
+            )
+        )
+
+    huge_dir, _ = trees["few_huge"]
+    huge = os.path.join(huge_dir, "huge0.txt")
+    huge_size = os.path.getsize(huge)
+    normalized = os.path.join(work, "huge_normalized.txt")
+    benchmarks.append(
+        (
+            "text_normalizer/replace_text",
+            huge_size,
+            lambda: _call(text_normalizer.run, [huge, normalized] + _REDACT["args"][2:]),
+        )
+    )
+    benchmarks.append(
+        (
+            "text_normalizer/exclude_line",
+            huge_size,
+            lambda: _call(text_normalizer.run, [huge, normalized, "--exclude-line", "foxtrot golf"]),
+        )
+    )
+
+    huge_copy = os.path.join(work, "huge_copy.txt")
+    shutil.copyfile(huge, huge_copy)
+    huge_changed = os.path.join(work, "huge_changed.txt")
+    shutil.copyfile(huge, huge_changed)
+    _mutate(huge_changed)
+    for mode in ("never", "always"):
+        for label, other in (("equal", huge_copy), ("one_change", huge_changed)):
+            benchmarks.append(
+                (
+                    "text_compare/{}/{}".format(mode, label),
+                    2 * huge_size,
+                    lambda other=other, mode=mode: _call(text_compare.run, [other, huge, "--streaming", mode]),
+                )
+            )
+
+    blobs_dir, _ = trees["binary_blobs"]
+    blob = os.path.join(blobs_dir, "blob00.bin")
+    blob_size = os.path.getsize(blob)
+    blob_copy = os.path.join(work, "blob_copy.bin")
+    shutil.copyfile(blob, blob_copy)
+    blob_changed = os.path.join(work, "blob_changed.bin")
+    shutil.copyfile(blob, blob_changed)
+    _mutate(blob_changed, 0.9)
+    for label, other in (("equal", blob_copy), ("late_change", blob_changed)):
+        benchmarks.append(
+            (
+                "binary_compare/" + label,
+                2 * blob_size,
+                lambda other=other: _call(binary_compare.run, [other, blob]),
+            )
+        )
+
+    rng = random.Random(7)
+    document = _json_document(rng, int(200000 * scale) or 1)
+    json_snapshot = os.path.join(work, "snapshot.json")
+    json_changed = os.path.join(work, "changed.json")
+    with open(json_snapshot, "w", encoding="utf-8") as handle:
+        json.dump(document, handle, indent=2)
+    document[len(document) // 2]["value"] += 1
+    with open(json_changed, "w", encoding="utf-8") as handle:
+        json.dump(document, handle, indent=2, sort_keys=True)
+    json_size = os.path.getsize(json_snapshot) + os.path.getsize(json_changed)
+    benchmarks.append(
+        (
+            "json_compare/one_change",
+            json_size,
+            lambda: _call(json_compare.run, [json_changed, json_snapshot]),
+        )
+    )
+    return benchmarks
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def format_table(results, baseline):
+    previous = {result["name"]: result for result in (baseline or {}).get("results", [])}
+    header = ["benchmark", "median s", "min s", "MiB/s"]
+    if baseline:
+        header.append("change")
+    rows = [header]
+    for result in results:
+        throughput = result["throughput_mib_s"]
+        row = [
+            result["name"],
+            "{:.4f}".format(result["median_s"]),
+            "{:.4f}".format(result["min_s"]),
+            "{:.1f}".format(throughput) if throughput else "-",
+        ]
+        if baseline:
+            before = previous.get(result["name"])
+            if before and before["median_s"]:
+                row.append("{:+.1f}%".format(100.0 * (result["median_s"] / before["median_s"] - 1)))
+            else:
+                row.append("new")
+        rows.append(row)
+    widths = [max(len(row[column]) for row in rows) for column in range(len(header))]
+    lines = []
+    for index, row in enumerate(rows):
+        cells = [row[0].ljust(widths[0])] + [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+        lines.append("  ".join(cells))
+        if index == 0:
+            lines.append("  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def _resolve_path(path):
+    # `bazel run` starts in the runfiles tree; relative paths mean the caller's directory.
+    if path and not os.path.isabs(path):
+        return os.path.join(os.environ.get("BUILD_WORKING_DIRECTORY", os.getcwd()), path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the snapshot runner and its built-in tools.")
+    parser.add_argument("--output", help="Write the JSON report to this path.")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark.")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplier for the size of the generated data (0.1 for a quick run).",
+    )
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this string.")
+    parser.add_argument("--workdir", help="Directory for generated data (defaults to a temporary directory).")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="Files process_outputs checks in parallel (0 for one per CPU, as in a test run).",
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(_resolve_path(args.baseline), "r", encoding="utf-8") as handle:
+            baseline = json.load(handle)
+
+    # Benchmarks measure the uncached paths with the parallelism from --jobs.
+    for key in ("SNAPSHOT_CACHE_DIR", "SNAPSHOT_JOBS", "SNAPSHOT_ACCEPT"):
+        os.environ.pop(key, None)
+
+    work = _resolve_path(args.workdir) or tempfile.mkdtemp(prefix="snapshot_bench_")
+    try:
+        print("Generating data in {}".format(work), file=sys.stderr)
+        trees = generate_trees(os.path.join(work, "trees"), args.scale)
+        results = []
+        for name, size, func in build_benchmarks(work, trees, args.scale, args.jobs):
+            if args.filter not in name:
+                continue
+            print("Running {}".format(name), file=sys.stderr)
+            func()  # Warm up file system caches and lazily compiled patterns.
+            timings = measure(func, args.repeat)
+            median = statistics.median(timings)
+            results.append(
+                {
+                    "name": name,
+                    "runs": timings,
+                    "median_s": median,
+                    "min_s": min(timings),
+                    "bytes": size,
+                    "throughput_mib_s": size / _MIB / median if size and median else None,
+                }
+            )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "jobs": args.jobs,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(_resolve_path(args.output), "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+            handle.write("\n")
+    print(format_table(results, baseline))
+
+
+if __name__ == "__main__":
+    main()
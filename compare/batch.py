@@ -0,0 +1,62 @@
+"""Batch mode shared by the comparators: one process checks many files.
+
+With `--batch MANIFEST`, a comparator reads one JSON object per line from
+MANIFEST, each holding the `rel_path`, `output` and `snapshot` of a file,
+and writes one JSON line per file to stdout:
+
+    {"rel_path": "...", "exit_code": 1, "stdout": "", "stderr": "<diff>"}
+
+The remaining arguments are the options of a single comparison and apply to
+every file. The exit code is 1 if any file differs.
+"""
+
+import argparse
+import io
+import json
+
+
+def split_batch_args(argv):
+    """Returns (manifest path or None, the other arguments)."""
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--batch")
+    args, rest = parser.parse_known_args(argv)
+    return args.batch, rest
+
+
+def run_manifest(run, manifest_path, options, stdout):
+    """Calls the single-file `run` for every entry of the manifest; returns the exit code."""
+    failed = False
+    with open(manifest_path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            exit_code, out, err = _run_one(run, [entry["snapshot"], entry["output"]] + options)
+            failed = failed or exit_code != 0
+            stdout.write(
+                json.dumps(
+                    {
+                        "rel_path": entry["rel_path"],
+                        "exit_code": exit_code,
+                        "stdout": out,
+                        "stderr": err,
+                    }
+                )
+                + "\n"
+            )
+            stdout.flush()
+    return 1 if failed else 0
+
+
+def _run_one(run, argv):
+    out = io.StringIO()
+    err = io.StringIO()
+    try:
+        exit_code = run(argv, out, err)
+    except SystemExit as exc:
+        # argparse reports usage errors by exiting.
+        exit_code = exc.code if isinstance(exc.code, int) else 1
+    except Exception as exc:  # pylint: disable=broad-except
+        print("{}: {}".format(type(exc).__name__, exc), file=err)
+        exit_code = 1
+    return exit_code, out.getvalue(), err.getvalue()
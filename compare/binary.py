@@ -1,23 +1,242 @@
 #!/usr/bin/env python3
-"""Binary comparator that checks for byte-for-byte equality."""
+"""Binary comparator that reports where files differ."""
 
 import argparse
-import filecmp
+import contextlib
+import mmap
+import os
+import re
+import shutil
 import sys
+import tempfile
 
+from compare import batch
+from compare import compressed
 
-def main():
+_CHUNK_SIZE = 1024 * 1024
+_NONZERO_RUN = re.compile(rb"[^\x00]+")
+_HEXDUMP_WIDTH = 16
+
+
+def parse_range(value):
+    """Parses START:END (END exclusive, empty for end of file); negative offsets count from the end."""
+    start, separator, end = value.partition(":")
+    if not separator:
+        raise argparse.ArgumentTypeError("expected START:END, got {!r}".format(value))
+    try:
+        return int(start or "0", 0), int(end, 0) if end else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid byte range {!r}".format(value))
+
+
+def resolve_ranges(ranges, size):
+    """Returns sorted, clamped (start, end) pairs for a file of `size` bytes."""
+    resolved = []
+    for start, end in ranges:
+        if start < 0:
+            start += size
+        if end is None:
+            end = size
+        elif end < 0:
+            end += size
+        start = min(max(start, 0), size)
+        end = min(max(end, 0), size)
+        if start < end:
+            resolved.append((start, end))
+    return sorted(resolved)
+
+
+@contextlib.contextmanager
+def _mapped(path, decompress=False):
+    if decompress:
+        # Decompressed data has no file to map, so it is spooled to one first.
+        with tempfile.TemporaryFile() as handle:
+            with compressed.open_read(path) as source:
+                shutil.copyfileobj(source, handle, _CHUNK_SIZE)
+            handle.flush()
+            with _mapped_handle(handle) as mapping:
+                yield mapping
+        return
+    with open(path, "rb") as handle:
+        with _mapped_handle(handle) as mapping:
+            yield mapping
+
+
+@contextlib.contextmanager
+def _mapped_handle(handle):
+    if os.fstat(handle.fileno()).st_size == 0:
+        # Empty files cannot be mapped.
+        yield b""
+        return
+    mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mapping, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mapping.madvise(mmap.MADV_SEQUENTIAL)
+        yield mapping
+    finally:
+        mapping.close()
+
+
+def _chunk_diff(left, right, start, ignored):
+    """Returns bytes that are zero wherever the chunks agree or the offset is ignored."""
+    length = len(left)
+    diff = (int.from_bytes(left, "little") ^ int.from_bytes(right, "little")).to_bytes(length, "little")
+    end = start + length
+    masked = None
+    for ignore_start, ignore_end in ignored:
+        if ignore_end <= start or ignore_start >= end:
+            continue
+        if masked is None:
+            masked = bytearray(diff)
+        low = max(ignore_start, start) - start
+        high = min(ignore_end, end) - start
+        masked[low:high] = bytes(high - low)
+    return bytes(masked) if masked is not None else diff
+
+
+def find_differences(left, right, length, ignored=(), stop_at_first=False):
+    """Yields merged (start, end) regions where the first `length` bytes differ."""
+    pending = None
+    for start in range(0, length, _CHUNK_SIZE):
+        end = min(start + _CHUNK_SIZE, length)
+        left_chunk = left[start:end]
+        right_chunk = right[start:end]
+        if left_chunk == right_chunk:
+            continue
+        diff = _chunk_diff(left_chunk, right_chunk, start, ignored)
+        for match in _NONZERO_RUN.finditer(diff):
+            region_start = start + match.start()
+            region_end = start + match.end()
+            if pending and pending[1] == region_start:
+                pending = (pending[0], region_end)
+                continue
+            if pending:
+                yield pending
+                if stop_at_first:
+                    return
+            pending = (region_start, region_end)
+    if pending:
+        yield pending
+
+
+def hexdump(data, start, end, out):
+    """Writes hexdump lines for data[start:end], aligned to _HEXDUMP_WIDTH."""
+    line_start = start - start % _HEXDUMP_WIDTH
+    while line_start < end:
+        chunk = data[line_start:min(line_start + _HEXDUMP_WIDTH, len(data))]
+        hex_part = " ".join("{:02x}".format(byte) for byte in chunk)
+        text = "".join(chr(byte) if 32 <= byte < 127 else "." for byte in chunk)
+        print(
+            "  {:08x}  {:<{width}}  |{}|".format(line_start, hex_part, text, width=_HEXDUMP_WIDTH * 3 - 1),
+            file=out,
+        )
+        line_start += _HEXDUMP_WIDTH
+
+
+def run(argv, stdout, stderr):
+    """Compare the files named in `argv`, reporting mismatches to `stderr`; returns the exit code.
+
+    With `--batch MANIFEST`, compares every file listed in MANIFEST instead; see compare/batch.py.
+    """
+    manifest, argv = batch.split_batch_args(argv)
+    if manifest:
+        return batch.run_manifest(run, manifest, argv, stdout)
     parser = argparse.ArgumentParser(description="Compare normalized binary output against snapshots.")
     parser.add_argument("normalized", help="Path to the normalized output file.")
     parser.add_argument("snapshot", help="Path to the snapshot file.")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--ignore-range",
+        action="append",
+        type=parse_range,
+        default=[],
+        help="Byte range START:END whose contents may differ, e.g. 0x10:0x18, "
+        "or --ignore-range=-32: for a trailer. Repeatable.",
+    )
+    parser.add_argument(
+        "--context",
+        type=int,
+        default=32,
+        help="Bytes of hexdump shown around the first difference.",
+    )
+    parser.add_argument(
+        "--max-regions",
+        type=int,
+        default=10,
+        help="Differing regions listed by offset (all are counted).",
+    )
+    parser.add_argument(
+        "--decompress",
+        action="append",
+        default=[],
+        help="Input path stored compressed (.gz or .zst), decompressed before comparing. Repeatable.",
+    )
+    args = parser.parse_args(argv)
+    decompress = frozenset(args.decompress)
 
-    if filecmp.cmp(args.snapshot, args.normalized, shallow=False):
-        return 0
+    with _mapped(args.normalized, args.normalized in decompress) as left, _mapped(
+        args.snapshot,
+        args.snapshot in decompress,
+    ) as right:
+        left_size = len(left)
+        right_size = len(right)
+        common = min(left_size, right_size)
+        ignored = resolve_ranges(args.ignore_range, common)
+        if left_size != right_size:
+            print("Binary snapshot mismatch: sizes differ", file=stderr)
+            print("  {}: {} bytes".format(args.normalized, left_size), file=stderr)
+            print("  {}: {} bytes".format(args.snapshot, right_size), file=stderr)
+            if not ignored:
+                # The sizes settle the result; scanning a large file would only add a hexdump.
+                return 1
+            # With ignored ranges, the first difference that counts is worth
+            # locating, but only that: regions of misaligned data are meaningless.
+            regions = list(find_differences(left, right, common, ignored, stop_at_first=True))
+            first = regions[0][0] if regions else common
+            _report_first_difference(args, left, right, first, stderr)
+            return 1
 
-    print("Binary snapshot mismatch.", file=sys.stderr)
+        regions = []
+        total = 0
+        differing = 0
+        for start, end in find_differences(left, right, common, ignored):
+            if len(regions) < args.max_regions:
+                regions.append((start, end))
+            total += 1
+            differing += end - start
+        if not total:
+            return 0
+
+        print(
+            "Binary snapshot mismatch: {} differing region{} ({} bytes)".format(
+                total,
+                "" if total == 1 else "s",
+                differing,
+            ),
+            file=stderr,
+        )
+        for start, end in regions:
+            print("  0x{:x}-0x{:x} ({} bytes)".format(start, end, end - start), file=stderr)
+        if total > len(regions):
+            print("  ... and {} more".format(total - len(regions)), file=stderr)
+        _report_first_difference(args, left, right, regions[0][0], stderr)
     return 1
 
 
+def _report_first_difference(args, left, right, offset, out):
+    print("First difference at offset 0x{:x} ({})".format(offset, offset), file=out)
+    start = max(offset - args.context // 2, 0)
+    for path, data in ((args.normalized, left), (args.snapshot, right)):
+        end = min(offset + args.context // 2 + 1, len(data))
+        print("{}:".format(path), file=out)
+        if start >= end:
+            print("  (end of file)", file=out)
+            continue
+        hexdump(data, start, end, out)
+
+
+def main():
+    return run(sys.argv[1:], sys.stdout, sys.stderr)
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,92 @@
+"""Reading and writing snapshots stored compressed next to their logical name.
+
+A snapshot for the output `dir/out.txt` may be stored as `dir/out.txt.gz` or
+`dir/out.txt.zst`. gzip support is built in; zstd needs Python 3.14's
+compression.zstd or the zstandard package.
+"""
+
+import gzip
+import shutil
+
+try:
+    from compression import zstd as _stdlib_zstd
+except ImportError:
+    _stdlib_zstd = None
+
+try:
+    import zstandard as _zstandard
+except ImportError:
+    _zstandard = None
+
+# Suffix appended to the logical name for each supported codec, in lookup order.
+SUFFIXES = {
+    ".gz": "gz",
+    ".zst": "zst",
+}
+
+_GZIP_LEVEL = 6
+_ZSTD_LEVEL = 10
+
+
+def codec_of(path):
+    """Returns the codec a compressed snapshot path is stored with, or None."""
+    for suffix, codec in SUFFIXES.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+
+def suffix_of(codec):
+    for suffix, candidate in SUFFIXES.items():
+        if candidate == codec:
+            return suffix
+    raise ValueError("unknown snapshot compression {!r}".format(codec))
+
+
+def zstd_available():
+    return _stdlib_zstd is not None or _zstandard is not None
+
+
+def _require_zstd():
+    if not zstd_available():
+        raise RuntimeError("zstd snapshots need Python 3.14 or the zstandard package")
+
+
+def open_read(path, decompress=True):
+    """Opens `path` for binary reading, decompressing it on the fly if it has a codec suffix."""
+    codec = codec_of(path) if decompress else None
+    if codec is None:
+        return open(path, "rb")
+    if codec == "gz":
+        return gzip.open(path, "rb")
+    _require_zstd()
+    if _stdlib_zstd is not None:
+        return _stdlib_zstd.open(path, "rb")
+    return _zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+
+
+def open_write(path, codec):
+    """Opens `path` for binary writing, compressing with `codec` unless it is None.
+
+    Output is deterministic: gzip headers carry no file name or timestamp.
+    """
+    if codec is None:
+        return open(path, "wb")
+    if codec == "gz":
+        raw = open(path, "wb")
+        handle = gzip.GzipFile(filename="", mode="wb", compresslevel=_GZIP_LEVEL, fileobj=raw, mtime=0)
+        # GzipFile only closes files it opened itself; this makes it close `raw` too.
+        handle.myfileobj = raw
+        return handle
+    if codec != "zst":
+        raise ValueError("unknown snapshot compression {!r}".format(codec))
+    _require_zstd()
+    if _stdlib_zstd is not None:
+        return _stdlib_zstd.open(path, "wb", level=_ZSTD_LEVEL)
+    return _zstandard.ZstdCompressor(level=_ZSTD_LEVEL).stream_writer(open(path, "wb"), closefd=True)
+
+
+def decompress_to(path, handle):
+    """Copies the decompressed contents of `path` into the open binary `handle`."""
+    with open_read(path) as source:
+        shutil.copyfileobj(source, handle, 1024 * 1024)
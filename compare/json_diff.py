@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""JSON comparator that reports structural differences by JSON pointer."""
+
+import argparse
+import json
+import math
+import sys
+
+from compare import batch
+from compare import compressed
+
+_MISSING = object()
+_MAX_VALUE_CHARS = 200
+_SCALAR_TYPES = frozenset([str, int, float, bool, type(None)])
+
+
+def load_document(path, decompress=False):
+    """Returns (document, may_contain_booleans)."""
+    with compressed.open_read(path, decompress) as handle:
+        data = handle.read()
+    return json.loads(data), b"true" in data or b"false" in data
+
+
+def escape_pointer_token(token):
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def parse_pointer(pointer):
+    """Splits a JSON pointer into unescaped reference tokens; "" is the whole document."""
+    if pointer == "":
+        return ()
+    if not pointer.startswith("/"):
+        raise ValueError("JSON pointer must be empty or start with '/': {!r}".format(pointer))
+    return tuple(token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/"))
+
+
+def format_pointer(tokens):
+    return "".join("/" + escape_pointer_token(token) for token in tokens) or "(root)"
+
+
+class _IgnoredPaths:
+    """Matches paths against JSON pointers where a `*` token matches any key or index."""
+
+    def __init__(self, pointers):
+        self._by_length = {}
+        for pointer in pointers:
+            tokens = parse_pointer(pointer)
+            self._by_length.setdefault(len(tokens), []).append(tokens)
+
+    def __bool__(self):
+        return bool(self._by_length)
+
+    def match(self, path):
+        # Array positions in `path` are ints; pointer tokens are always strings.
+        for pattern in self._by_length.get(len(path), ()):
+            if all(expected == "*" or expected == str(token) for expected, token in zip(pattern, path)):
+                return True
+        return False
+
+
+_TYPE_NAMES = {
+    type(None): "null",
+    bool: "boolean",
+    int: "number",
+    float: "number",
+    str: "string",
+    list: "array",
+    dict: "object",
+}
+
+
+def _type_name(value):
+    return _TYPE_NAMES[type(value)]
+
+
+def _format_value(value):
+    text = json.dumps(value, sort_keys=True, ensure_ascii=False)
+    if len(text) > _MAX_VALUE_CHARS:
+        text = text[:_MAX_VALUE_CHARS] + "..."
+    return text
+
+
+def _numbers_equal(expected, actual, abs_tol, rel_tol):
+    if expected == actual:
+        return True
+    if not (abs_tol or rel_tol):
+        return False
+    return math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=abs_tol)
+
+
+def _identical(left, right, containers):
+    """Cheaply detects equal subtrees so they need not be walked node by node.
+
+    Python equality treats true as 1, so containers are only trusted when
+    `containers` says the documents hold no booleans.
+    """
+    value_type = type(left)
+    if value_type is not type(right):
+        return False
+    if value_type in _SCALAR_TYPES or containers:
+        return left == right
+    return False
+
+
+def compare_documents(expected, actual, ignored=None, abs_tol=0.0, rel_tol=0.0, booleans=True):
+    """Yields (path_tokens, message) for every difference between two parsed documents.
+
+    Differences are reported in document order. Objects are compared by key,
+    arrays element by element, and numbers within the given tolerances.
+    Passing booleans=False promises neither document contains true or false,
+    which lets equal subtrees be skipped without walking them.
+    """
+    containers = not booleans
+    ignored = ignored or _IgnoredPaths([])
+    if _identical(expected, actual, containers):
+        return
+    stack = [((), expected, actual)]
+    while stack:
+        path, left, right = stack.pop()
+        if ignored and ignored.match(path):
+            continue
+        if left is _MISSING:
+            yield path, "unexpected in output: {}".format(_format_value(right))
+            continue
+        if right is _MISSING:
+            yield path, "missing from output, snapshot has {}".format(_format_value(left))
+            continue
+        left_type = _type_name(left)
+        right_type = _type_name(right)
+        if left_type != right_type:
+            yield path, "type changed from {} to {}: {} -> {}".format(
+                left_type,
+                right_type,
+                _format_value(left),
+                _format_value(right),
+            )
+            continue
+        if left_type == "object":
+            children = [(key, value, right.get(key, _MISSING)) for key, value in left.items()]
+            children.extend((key, _MISSING, value) for key, value in right.items() if key not in left)
+        elif left_type == "array":
+            children = [(index, pair[0], pair[1]) for index, pair in enumerate(zip(left, right))]
+            common = len(children)
+            children.extend((index, value, _MISSING) for index, value in enumerate(left[common:], common))
+            children.extend((index, _MISSING, value) for index, value in enumerate(right[common:], common))
+        else:
+            if left_type == "number":
+                equal = _numbers_equal(left, right, abs_tol, rel_tol)
+            else:
+                equal = left == right
+            if not equal:
+                yield path, "value changed: {} -> {}".format(_format_value(left), _format_value(right))
+            continue
+        pending = []
+        for token, child_left, child_right in children:
+            if _identical(child_left, child_right, containers):
+                continue
+            pending.append((path + (token,), child_left, child_right))
+        stack.extend(reversed(pending))
+
+
+def run(argv, stdout, stderr):
+    """Compare the files named in `argv`, reporting differences to `stderr`; returns the exit code.
+
+    With `--batch MANIFEST`, compares every file listed in MANIFEST instead; see compare/batch.py.
+    """
+    manifest, argv = batch.split_batch_args(argv)
+    if manifest:
+        return batch.run_manifest(run, manifest, argv, stdout)
+    parser = argparse.ArgumentParser(description="Compare normalized JSON output against snapshots.")
+    parser.add_argument("normalized", help="Path to the normalized output file.")
+    parser.add_argument("snapshot", help="Path to the snapshot file.")
+    parser.add_argument(
+        "--float-tolerance",
+        type=float,
+        default=0.0,
+        help="Numbers within this absolute difference are considered equal.",
+    )
+    parser.add_argument(
+        "--relative-tolerance",
+        type=float,
+        default=0.0,
+        help="Numbers within this relative difference are considered equal.",
+    )
+    parser.add_argument(
+        "--ignore-path",
+        action="append",
+        default=[],
+        help="JSON pointer to skip, such as /metadata/timestamp; '*' matches any key or index. Repeatable.",
+    )
+    parser.add_argument(
+        "--max-differences",
+        type=int,
+        default=50,
+        help="Stop after reporting this many differences (0 for no limit).",
+    )
+    parser.add_argument(
+        "--decompress",
+        action="append",
+        default=[],
+        help="Input path stored compressed (.gz or .zst), decompressed while reading. Repeatable.",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        ignored = _IgnoredPaths(args.ignore_path)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    documents = []
+    booleans = False
+    for label, path in (("snapshot", args.snapshot), ("output", args.normalized)):
+        try:
+            document, has_booleans = load_document(path, path in args.decompress)
+        except ValueError as exc:
+            print("Invalid JSON in {} {}: {}".format(label, path, exc), file=stderr)
+            return 1
+        documents.append(document)
+        booleans = booleans or has_booleans
+
+    differences = 0
+    for path, message in compare_documents(
+        documents[0],
+        documents[1],
+        ignored,
+        args.float_tolerance,
+        args.relative_tolerance,
+        booleans,
+    ):
+        if args.max_differences and differences >= args.max_differences:
+            print("... stopped after {} differences".format(args.max_differences), file=stderr)
+            break
+        if differences == 0:
+            print("--- {}".format(args.snapshot), file=stderr)
+            print("+++ {}".format(args.normalized), file=stderr)
+        print("{}: {}".format(format_pointer(path), message), file=stderr)
+        differences += 1
+    return 1 if differences else 0
+
+
+def main():
+    return run(sys.argv[1:], sys.stdout, sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
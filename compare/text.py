@@ -2,27 +2,423 @@
 """Text comparator that emits a unified diff on mismatch."""
 
 import argparse
+import collections
 import difflib
 import filecmp
+import io
+import itertools
+import os
 import sys
 
+from compare import batch
+from compare import compressed
 
-def read_lines(path):
-    with open(path, "r", encoding="utf-8", errors="replace", newline="") as handle:
+_CHUNK_SIZE = 1024 * 1024
+_CONTEXT_LINES = 3
+_EOF = object()
+
+
+def read_lines(path, decompress=False):
+    handle = io.TextIOWrapper(compressed.open_read(path, decompress), encoding="utf-8", errors="replace", newline="")
+    with handle:
         return handle.read().splitlines(keepends=True)
 
 
-def main():
+def same_content(left_path, right_path, decompress=()):
+    """Returns True if both files hold the same bytes; paths in `decompress` are read decompressed."""
+    if not decompress:
+        return filecmp.cmp(left_path, right_path, shallow=False)
+    with compressed.open_read(left_path, left_path in decompress) as left:
+        with compressed.open_read(right_path, right_path in decompress) as right:
+            while True:
+                left_chunk = _read_full(left, _CHUNK_SIZE)
+                if left_chunk != _read_full(right, _CHUNK_SIZE):
+                    return False
+                if not left_chunk:
+                    return True
+
+
+def _read_full(handle, size):
+    """Reads `size` bytes, or fewer only at end of file; decompressors may return short reads."""
+    data = handle.read(size)
+    while data and len(data) < size:
+        chunk = handle.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class _LineReader:
+    """Reads a file as bytes lines, with lookahead and a fast skip over common prefixes."""
+
+    def __init__(self, handle):
+        self._handle = handle
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+        self.lookahead = collections.deque()
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self._handle.read(_CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _readline(self):
+        while True:
+            end = self._buffer.find(b"\n", self._pos)
+            if end >= 0:
+                line = self._buffer[self._pos:end + 1]
+                self._pos = end + 1
+                return line
+            if not self._fill():
+                line = self._buffer[self._pos:]
+                self._pos = len(self._buffer)
+                return line or None
+
+    def peek(self, count):
+        """Buffers up to `count` lines; returns (lines, reached_eof)."""
+        while len(self.lookahead) < count:
+            line = self._readline()
+            if line is None:
+                return list(self.lookahead), True
+            self.lookahead.append(line)
+        return list(itertools.islice(self.lookahead, count)), False
+
+    def pop(self, count=1):
+        return [self.lookahead.popleft() for _ in range(count)]
+
+    def skip_common(self, other):
+        """Consumes the byte-identical prefix of both readers, stopping at a line start.
+
+        Returns (skipped_line_count, skipped_tail_bytes). Only valid when both
+        lookahead buffers are empty.
+        """
+        skipped = 0
+        tail = b""
+        while True:
+            if self._pos >= len(self._buffer):
+                self._fill()
+            if other._pos >= len(other._buffer):
+                other._fill()
+            size = min(len(self._buffer) - self._pos, len(other._buffer) - other._pos)
+            if size == 0:
+                return skipped, tail
+            mine = self._buffer[self._pos:self._pos + size]
+            theirs = other._buffer[other._pos:other._pos + size]
+            if mine != theirs:
+                size = _common_prefix_length(mine, theirs)
+            end = mine.rfind(b"\n", 0, size) + 1
+            if end == 0:
+                if size < len(mine) or self._eof or other._eof:
+                    return skipped, tail
+                # A single line longer than the buffer: read more before deciding.
+                self._fill()
+                other._fill()
+                continue
+            consumed = mine[:end]
+            skipped += consumed.count(b"\n")
+            tail = _last_lines(tail + consumed, _CONTEXT_LINES)
+            self._pos += end
+            other._pos += end
+            if size < len(mine):
+                return skipped, tail
+
+
+def _common_prefix_length(left, right):
+    low, high = 0, min(len(left), len(right))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if left[:mid] == right[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def _last_lines(data, count):
+    start = len(data)
+    for _ in range(count):
+        if start == 0:
+            return data
+        start = data.rfind(b"\n", 0, start - 1) + 1
+    return data[start:]
+
+
+def _split_lines(data):
+    return data.splitlines(keepends=True)
+
+
+def _format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return "{}".format(beginning)
+    if not length:
+        beginning -= 1
+    return "{},{}".format(beginning, length)
+
+
+def _find_anchor(golden, golden_eof, normalized, normalized_eof, anchor_lines):
+    """Finds the closest (i, j) where both windows share `anchor_lines` lines (or end together)."""
+
+    def key(lines, eof, index):
+        segment = tuple(lines[index:index + anchor_lines])
+        if len(segment) < anchor_lines:
+            if not eof:
+                return None
+            segment += (_EOF,)
+        return segment
+
+    seen_golden = {}
+    seen_normalized = {}
+    limit = max(len(golden), len(normalized))
+    for index in range(limit + 1):
+        candidates = []
+        if index <= len(golden):
+            golden_key = key(golden, golden_eof, index)
+            if golden_key is not None:
+                seen_golden.setdefault(golden_key, index)
+                if golden_key in seen_normalized:
+                    candidates.append((index, seen_normalized[golden_key]))
+        if index <= len(normalized):
+            normalized_key = key(normalized, normalized_eof, index)
+            if normalized_key is not None:
+                seen_normalized.setdefault(normalized_key, index)
+                if normalized_key in seen_golden:
+                    candidates.append((seen_golden[normalized_key], index))
+        if candidates:
+            return min(candidates, key=sum)
+    return None
+
+
+class _HunkWriter:
+    def __init__(self, out, fromfile, tofile, max_hunks, max_hunk_lines):
+        self._out = out
+        self._fromfile = fromfile
+        self._tofile = tofile
+        self._max_hunks = max_hunks
+        self._max_hunk_lines = max_hunk_lines
+        self._hunks = 0
+        self._hunk = None
+        self._pending = []
+
+    @property
+    def full(self):
+        return bool(self._max_hunks) and self._hunks >= self._max_hunks
+
+    @property
+    def in_hunk(self):
+        return self._hunk is not None
+
+    def equal(self, lines):
+        if self._hunk is None:
+            return
+        self._pending.extend(lines)
+        if len(self._pending) > 2 * _CONTEXT_LINES:
+            self._close()
+
+    def change(self, removed, added, golden_pos, normalized_pos, context):
+        """Records a change starting at the given 0-based line positions."""
+        if self._hunk is None:
+            self._hunk = {
+                "golden_start": golden_pos - len(context),
+                "normalized_start": normalized_pos - len(context),
+                "golden_count": 0,
+                "normalized_count": 0,
+                "lines": [],
+            }
+            self._add_context(context)
+        else:
+            self._add_context(self._pending)
+        self._pending = []
+        hunk = self._hunk
+        hunk["lines"].extend(b"-" + line for line in removed)
+        hunk["lines"].extend(b"+" + line for line in added)
+        hunk["golden_count"] += len(removed)
+        hunk["normalized_count"] += len(added)
+        if len(hunk["lines"]) > self._max_hunk_lines:
+            self._close()
+
+    def finish(self):
+        if self._hunk is not None:
+            self._close()
+
+    def truncated(self, message):
+        self.finish()
+        print(message, file=self._out)
+
+    def _add_context(self, lines):
+        hunk = self._hunk
+        hunk["lines"].extend(b" " + line for line in lines)
+        hunk["golden_count"] += len(lines)
+        hunk["normalized_count"] += len(lines)
+
+    def _close(self):
+        self._add_context(self._pending[:_CONTEXT_LINES])
+        self._pending = []
+        hunk = self._hunk
+        self._hunk = None
+        if self._hunks == 0:
+            print("--- {}".format(self._fromfile), file=self._out)
+            print("+++ {}".format(self._tofile), file=self._out)
+        self._hunks += 1
+        golden_start = hunk["golden_start"]
+        normalized_start = hunk["normalized_start"]
+        print(
+            "@@ -{} +{} @@".format(
+                _format_range(golden_start, golden_start + hunk["golden_count"]),
+                _format_range(normalized_start, normalized_start + hunk["normalized_count"]),
+            ),
+            file=self._out,
+        )
+        for line in hunk["lines"]:
+            text = line.decode("utf-8", errors="replace")
+            if not text.endswith("\n"):
+                text += "\n\\ No newline at end of file\n"
+            self._out.write(text)
+
+
+def streaming_diff(golden_path, normalized_path, out, window_lines, max_hunks, decompress=()):
+    """Writes a unified diff using memory bounded by `window_lines`.
+
+    Identical stretches are skipped in large byte chunks. After a divergence,
+    up to `window_lines` lines of each file are buffered and the nearest run of
+    matching lines is used to resynchronize, which keeps the work linear in the
+    file size.
+    """
+    writer = _HunkWriter(out, golden_path, normalized_path, max_hunks, 2 * window_lines)
+    golden_handle = compressed.open_read(golden_path, golden_path in decompress)
+    normalized_handle = compressed.open_read(normalized_path, normalized_path in decompress)
+    with golden_handle, normalized_handle:
+        golden = _LineReader(golden_handle)
+        normalized = _LineReader(normalized_handle)
+        golden_pos = 0
+        normalized_pos = 0
+        context = collections.deque(maxlen=_CONTEXT_LINES)
+        while not writer.full:
+            if not golden.lookahead and not normalized.lookahead and not writer.in_hunk:
+                skipped, tail = golden.skip_common(normalized)
+                golden_pos += skipped
+                normalized_pos += skipped
+                context.extend(_split_lines(tail))
+            golden_line, golden_eof = golden.peek(1)
+            normalized_line, normalized_eof = normalized.peek(1)
+            if golden_eof and normalized_eof:
+                break
+            if golden_line and golden_line == normalized_line:
+                golden.pop()
+                normalized.pop()
+                writer.equal(golden_line)
+                context.extend(golden_line)
+                golden_pos += 1
+                normalized_pos += 1
+                continue
+            golden_window, golden_eof = golden.peek(window_lines)
+            normalized_window, normalized_eof = normalized.peek(window_lines)
+            anchor = _find_anchor(
+                golden_window,
+                golden_eof,
+                normalized_window,
+                normalized_eof,
+                _CONTEXT_LINES,
+            )
+            if anchor is None:
+                writer.change(
+                    golden.pop(len(golden_window)),
+                    normalized.pop(len(normalized_window)),
+                    golden_pos,
+                    normalized_pos,
+                    list(context),
+                )
+                writer.truncated(
+                    "... no matching lines within {} lines; remaining differences not shown".format(window_lines)
+                )
+                return
+            removed, added = anchor
+            writer.change(
+                golden.pop(removed),
+                normalized.pop(added),
+                golden_pos,
+                normalized_pos,
+                list(context),
+            )
+            golden_pos += removed
+            normalized_pos += added
+            context.clear()
+        if writer.full:
+            writer.truncated("... diff truncated after {} hunks".format(max_hunks))
+            return
+        writer.finish()
+
+
+def _use_streaming(mode, threshold, paths):
+    if mode == "always":
+        return True
+    if mode == "never":
+        return False
+    return any(os.path.getsize(path) > threshold for path in paths)
+
+
+def run(argv, stdout, stderr):
+    """Compare the files named in `argv`, writing the diff to `stderr`; returns the exit code.
+
+    With `--batch MANIFEST`, compares every file listed in MANIFEST instead; see compare/batch.py.
+    """
+    manifest, argv = batch.split_batch_args(argv)
+    if manifest:
+        return batch.run_manifest(run, manifest, argv, stdout)
     parser = argparse.ArgumentParser(description="Compare normalized text against snapshots.")
     parser.add_argument("normalized", help="Path to the normalized output file.")
     parser.add_argument("snapshot", help="Path to the snapshot file.")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--max-hunks",
+        type=int,
+        default=0,
+        help="Stop after printing this many diff hunks (0 for no limit).",
+    )
+    parser.add_argument(
+        "--streaming",
+        choices=["auto", "always", "never"],
+        default="auto",
+        help="Use the bounded-memory diff; 'auto' enables it for files above --streaming-threshold.",
+    )
+    parser.add_argument(
+        "--streaming-threshold",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="File size in bytes above which --streaming=auto switches to the bounded-memory diff.",
+    )
+    parser.add_argument(
+        "--window-lines",
+        type=int,
+        default=10000,
+        help="Lines buffered per file while resynchronizing a streaming diff.",
+    )
+    parser.add_argument(
+        "--decompress",
+        action="append",
+        default=[],
+        help="Input path stored compressed (.gz or .zst), decompressed while reading. Repeatable.",
+    )
+    args = parser.parse_args(argv)
+    decompress = frozenset(args.decompress)
 
-    if filecmp.cmp(args.normalized, args.snapshot, shallow=False):
+    if same_content(args.normalized, args.snapshot, decompress):
         return 0
 
-    normalized = read_lines(args.normalized)
-    golden = read_lines(args.snapshot)
+    if _use_streaming(args.streaming, args.streaming_threshold, [args.normalized, args.snapshot]):
+        streaming_diff(args.snapshot, args.normalized, stderr, args.window_lines, args.max_hunks, decompress)
+        return 1
+
+    normalized = read_lines(args.normalized, args.normalized in decompress)
+    golden = read_lines(args.snapshot, args.snapshot in decompress)
 
     diff = difflib.unified_diff(
         golden,
@@ -32,10 +428,20 @@ def main():
         lineterm="",
         n=3,
     )
+    hunks = 0
     for line in diff:
-        print(line, file=sys.stderr)
+        if line.startswith("@@"):
+            hunks += 1
+            if args.max_hunks and hunks > args.max_hunks:
+                print("... diff truncated after {} hunks".format(args.max_hunks), file=stderr)
+                break
+        print(line, file=stderr)
     return 1
 
 
+def main():
+    return run(sys.argv[1:], sys.stdout, sys.stderr)
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,55 @@
+"""Runs a snapshot_test that must fail and checks that it reports the expected file.
+
+Usage: expect_failure_test NAME EXPECTED RLOCATION_PATH...
+
+NAME is the snapshot_test target, which should be tagged "manual" so that it
+is only run through this test, EXPECTED a string its output must contain
+(with "/" as path separator), and the RLOCATION_PATHs are
+`$(rlocationpaths NAME)`.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+
+from python.runfiles import runfiles
+
+# Set by Bazel for this test; the wrapped snapshot_test must not inherit them.
+_OWN_TEST_ENV = [
+    "TEST_SHARD_INDEX",
+    "TEST_SHARD_STATUS_FILE",
+    "TEST_TOTAL_SHARDS",
+    "TEST_UNDECLARED_OUTPUTS_DIR",
+    "XML_OUTPUT_FILE",
+]
+
+
+def main():
+    name, expected = sys.argv[1], sys.argv[2]
+    launcher_path = next(path for path in sys.argv[3:] if not path.endswith(".zip"))
+    runfiles_ctx = runfiles.Create()
+    launcher = runfiles_ctx.Rlocation(launcher_path)
+
+    env = {key: value for key, value in os.environ.items() if key not in _OWN_TEST_ENV}
+    env.update(runfiles_ctx.EnvVars())
+    env["SNAPSHOT_CONFIG"] = "{}/{}_config.json".format(os.path.dirname(launcher_path), name)
+    with tempfile.TemporaryDirectory(dir=os.environ.get("TEST_TMPDIR")) as outputs_dir:
+        env["TEST_UNDECLARED_OUTPUTS_DIR"] = outputs_dir
+        result = subprocess.run(
+            [launcher],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            check=False,
+        )
+    output = result.stdout.decode("utf-8", errors="replace")
+    print(output)
+    if result.returncode == 0:
+        sys.exit("{} passed, but it must fail".format(name))
+    if expected not in output.replace(os.sep, "/"):
+        sys.exit("{} failed without reporting {!r}".format(name, expected))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+#!/usr/bin/env bash
+# Normalizer that copies INPUT to OUTPUT, but fails unless it was started
+# with SIGPIPE at its default disposition: a writer whose reader went away
+# must be killed by SIGPIPE (status 141), not see EPIPE and exit 1.
+set -o pipefail
+yes | head -n 1 >/dev/null
+status=$?
+if [ "$status" -ne 141 ]; then
+    echo "SIGPIPE is not at its default: 'yes | head' exited with $status" >&2
+    exit 1
+fi
+cp "$1" "$2"
@@ -0,0 +1,111 @@
+"""Writes the outputs for the snapshot tests of individual runner and comparator modes.
+
+Each argument names a mode; its outputs are written under SNAPSHOT_OUTPUTS_DIR.
+"""
+
+import json
+import os
+import struct
+import sys
+import time
+from pathlib import Path
+
+# How long the stream mode waits for the runner to pick up a reported output.
+_STREAM_WAIT_SECONDS = 10
+
+
+def write_stream(output_dir):
+    """Writes passthrough outputs and reports each one on SNAPSHOT_READY_FILE as soon as it is done."""
+    ready_file = os.environ.get("SNAPSHOT_READY_FILE")
+    for rel_path, content in (("stream/a.txt", b"streamed a\n"), ("stream/b.log", b"streamed b\n")):
+        path = output_dir / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        if ready_file:
+            with open(ready_file, "a", encoding="utf-8") as handle:
+                handle.write(rel_path + "\n")
+    if not ready_file:
+        return
+    # With keep_raw = False, a passthrough output that was checked early is
+    # moved out of the outputs directory. Waiting for that makes sure the
+    # test covers files the runner no longer finds there after the test exits.
+    deadline = time.monotonic() + _STREAM_WAIT_SECONDS
+    while (output_dir / "stream/a.txt").exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def write_json(output_dir):
+    """Writes a JSON report whose timestamps change on every run, including inside an array."""
+    now = time.time()
+    report = {
+        "generated": now,
+        "items": [
+            {"name": "first", "ts": now, "size": 3},
+            {"name": "second", "ts": now + 1, "size": 5},
+        ],
+    }
+    path = output_dir / "json/report.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+
+
+def write_batch(output_dir):
+    """Writes several small text files, each compared in the same comparator call."""
+    path = output_dir / "batch"
+    path.mkdir(parents=True, exist_ok=True)
+    for index in range(5):
+        (path / "{}.txt".format(index)).write_text("batch file {}\n".format(index), encoding="utf-8")
+
+
+def write_binary(output_dir):
+    """Writes a binary file with a header, an embedded timestamp at bytes 4:12, and a payload."""
+    path = output_dir / "binary/image.bin"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"SNAP" + struct.pack("<d", time.time()) + bytes(range(256)) * 4)
+
+
+def write_compressed(output_dir):
+    """Writes outputs whose snapshots are stored gzip-compressed."""
+    path = output_dir / "compressed/log.txt"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join("line {}\n".format(index) for index in range(200)), encoding="utf-8")
+    document = {"entries": [{"index": index, "square": index * index} for index in range(50)]}
+    (output_dir / "compressed/entries.json").write_text(json.dumps(document) + "\n", encoding="utf-8")
+
+
+def write_pipeline(output_dir):
+    """Writes a timestamped log, mostly DEBUG lines, larger than a pipe buffer."""
+    now = time.time()
+    path = output_dir / "pipeline/log.txt"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf-8") as handle:
+        for index in range(4000):
+            level = "INFO" if index % 100 == 0 else "DEBUG"
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now + index))
+            handle.write("{} request #{} at {}\n".format(level, index, stamp))
+
+
+_MODES = {
+    "batch": write_batch,
+    "binary": write_binary,
+    "compressed": write_compressed,
+    "json": write_json,
+    "pipeline": write_pipeline,
+    "stream": write_stream,
+}
+
+
+def main():
+    output_root = os.environ.get("SNAPSHOT_OUTPUTS_DIR")
+    if not output_root:
+        raise SystemExit("SNAPSHOT_OUTPUTS_DIR must be set")
+    output_dir = Path(output_root)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for mode in sys.argv[1:]:
+        if mode not in _MODES:
+            raise SystemExit("unknown mode {!r}; expected one of {}".format(mode, ", ".join(sorted(_MODES))))
+        _MODES[mode](output_dir)
+
+
+if __name__ == "__main__":
+    main()
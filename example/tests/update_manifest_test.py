@@ -0,0 +1,114 @@
+"""Runs update_all targets against fake test outputs and checks how they find the tests.
+
+Usage: update_manifest_test PACKAGE_RLOCATION_PATHS -- RECURSIVE_RLOCATION_PATHS
+
+The two lists are `$(rlocationpaths)` of an update_all target of this package
+and of a recursive one. No `bazel query` can run here, so whenever the updater
+has to fall back to it, the labels it would find come from
+SNAPSHOT_UPDATE_LABELS instead.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from python.runfiles import runfiles
+
+_PACKAGE = "tests"
+_INCOMPLETE = "Target manifest is incomplete"
+
+# Set for this test, or for `bazel run` of an update_all; the updater must not inherit them.
+_OWN_ENV = [
+    "SNAPSHOT_UPDATE_ACCEPT",
+    "SNAPSHOT_UPDATE_LABELS",
+    "SNAPSHOT_UPDATE_PATTERNS",
+    "TEST_SHARD_INDEX",
+    "TEST_SHARD_STATUS_FILE",
+    "TEST_TOTAL_SHARDS",
+    "TEST_UNDECLARED_OUTPUTS_DIR",
+    "XML_OUTPUT_FILE",
+]
+
+
+def _launcher_path(paths):
+    return next(path for path in paths if not path.endswith(".zip"))
+
+
+def _write_outputs(workspace, name, content):
+    """Leaves the outputs of a passing run of //tests:NAME under bazel-testlogs."""
+    outputs_dir = os.path.join(workspace, "bazel-testlogs", _PACKAGE, name, "test.outputs")
+    os.makedirs(os.path.join(outputs_dir, "normalized"))
+    with open(os.path.join(outputs_dir, "normalized", "out.txt"), "w", encoding="utf-8") as handle:
+        handle.write(content)
+    with open(os.path.join(outputs_dir, "snapshot_outputs.json"), "w", encoding="utf-8") as handle:
+        json.dump({"complete": True, "outputs": ["out.txt"]}, handle)
+
+
+def _read_snapshot(workspace, name):
+    path = os.path.join(workspace, _PACKAGE, "snapshots", name, "out.txt")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as handle:
+        return handle.read()
+
+
+def _run_update(runfiles_ctx, launcher_path, workspace, labels=None):
+    env = {key: value for key, value in os.environ.items() if key not in _OWN_ENV}
+    env.update(runfiles_ctx.EnvVars())
+    env["BUILD_WORKSPACE_DIRECTORY"] = workspace
+    env["SNAPSHOT_UPDATE_MANIFEST"] = launcher_path + ".targets.json"
+    if labels:
+        env["SNAPSHOT_UPDATE_LABELS"] = "\n".join(labels)
+    result = subprocess.run(
+        [runfiles_ctx.Rlocation(launcher_path)],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        check=False,
+    )
+    output = result.stdout.decode("utf-8", errors="replace")
+    print(output)
+    if result.returncode != 0:
+        sys.exit("{} failed with exit code {}".format(launcher_path, result.returncode))
+    return output
+
+
+def main():
+    separator = sys.argv.index("--")
+    package_launcher = _launcher_path(sys.argv[1:separator])
+    recursive_launcher = _launcher_path(sys.argv[separator + 1:])
+    runfiles_ctx = runfiles.Create()
+
+    with tempfile.TemporaryDirectory(dir=os.environ.get("TEST_TMPDIR")) as workspace:
+        os.makedirs(os.path.join(workspace, _PACKAGE))
+        open(os.path.join(workspace, _PACKAGE, "BUILD.bazel"), "w").close()
+
+        # Every test with outputs is in the manifest, so no query is needed.
+        _write_outputs(workspace, "stream", "first\n")
+        output = _run_update(runfiles_ctx, package_launcher, workspace)
+        if _INCOMPLETE in output:
+            sys.exit("the complete manifest was not used")
+        if _read_snapshot(workspace, "stream") != "first\n":
+            sys.exit("//tests:stream was not updated from the manifest")
+
+        # A test declared after the manifest was recorded forces the query.
+        _write_outputs(workspace, "undeclared", "second\n")
+        output = _run_update(runfiles_ctx, package_launcher, workspace, ["//tests:undeclared"])
+        if _INCOMPLETE not in output:
+            sys.exit("the incomplete manifest was not detected")
+        if _read_snapshot(workspace, "undeclared") != "second\n":
+            sys.exit("//tests:undeclared was not updated after the query")
+
+        # A recursive manifest records no packages and always queries, quietly.
+        _write_outputs(workspace, "stream_recursive", "third\n")
+        output = _run_update(runfiles_ctx, recursive_launcher, workspace, ["//tests:stream_recursive"])
+        if _INCOMPLETE in output:
+            sys.exit("the recursive manifest was reported as incomplete")
+        if _read_snapshot(workspace, "stream_recursive") != "third\n":
+            sys.exit("//tests:stream_recursive was not updated after the query")
+
+
+if __name__ == "__main__":
+    main()
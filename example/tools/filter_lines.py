@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Streaming normalizer that redacts and drops lines, reading and writing front to back."""
+
+import argparse
+import re
+import signal
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter the lines of a snapshot output.")
+    parser.add_argument("raw_path")
+    parser.add_argument("normalized_path")
+    parser.add_argument("--redact", action="append", default=[], help="Regex whose matches become REDACTED.")
+    parser.add_argument("--drop", action="append", default=[], help="Regex of lines to drop.")
+    parser.add_argument("--max-lines", type=int, default=0, help="Fail if more lines are kept (0 for no limit).")
+    args = parser.parse_args()
+
+    # Like other filters in a pipeline, stop quietly when the next stage goes away.
+    if hasattr(signal, "SIGPIPE"):
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    redact = [re.compile(pattern) for pattern in args.redact]
+    drop = [re.compile(pattern) for pattern in args.drop]
+    kept = 0
+    with open(args.raw_path, "r", encoding="utf-8") as source, open(
+        args.normalized_path, "w", encoding="utf-8"
+    ) as output:
+        for line in source:
+            if any(pattern.search(line) for pattern in drop):
+                continue
+            kept += 1
+            if args.max_lines and kept > args.max_lines:
+                sys.exit("{}: more than {} lines".format(args.raw_path, args.max_lines))
+            for pattern in redact:
+                line = pattern.sub("REDACTED", line)
+            output.write(line)
+
+
+if __name__ == "__main__":
+    main()
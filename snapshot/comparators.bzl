@@ -0,0 +1,130 @@
+"""Snapshot comparator helpers."""
+
+load("//snapshot/private:command_tool.bzl", "snapshot_comparator")
+
+
+def text_comparator(
+        name,
+        max_hunks = None,
+        streaming = None,
+        streaming_threshold = None,
+        window_lines = None,
+        batch = False,
+        **kwargs):
+    """Define a snapshot comparator that prints a unified diff of text files.
+
+    Args:
+        name: Target name.
+        max_hunks: Maximum number of diff hunks printed per file.
+        streaming: Bounded-memory diff mode: "always", "never", or None to use it only for large files.
+        streaming_threshold: File size in bytes above which the bounded-memory diff is used by default.
+        window_lines: Lines buffered per file while resynchronizing a bounded-memory diff.
+        batch: Compare all files of a test in one call instead of one call per file.
+        **kwargs: Extra attributes forwarded to `snapshot_comparator`.
+    """
+    if streaming and streaming not in ["always", "never"]:
+        fail("streaming must be 'always', 'never', or None")
+    tool_label = Label("//compare:text")
+    args = ["--batch", "{MANIFEST}"] if batch else ["{SNAPSHOT}", "{OUTPUT}"]
+    if max_hunks != None:
+        args.extend(["--max-hunks", str(max_hunks)])
+    if streaming:
+        args.extend(["--streaming", streaming])
+    if streaming_threshold != None:
+        args.extend(["--streaming-threshold", str(streaming_threshold)])
+    if window_lines != None:
+        args.extend(["--window-lines", str(window_lines)])
+
+    snapshot_comparator(
+        name = name,
+        executable = tool_label,
+        args = args,
+        batch = batch,
+        **kwargs
+    )
+
+
+def binary_comparator(
+        name,
+        ignore_ranges = None,
+        context_bytes = None,
+        max_regions = None,
+        batch = False,
+        **kwargs):
+    """Define a snapshot comparator that compares files byte for byte.
+
+    Mismatches report the first differing offset with a hexdump of both
+    files and the number of differing regions. Files of different sizes
+    are reported by their sizes alone, without reading them, unless
+    `ignore_ranges` is set.
+
+    Args:
+        name: Target name.
+        ignore_ranges: List of "START:END" byte ranges that may differ, such as "0x10:0x18" for an
+            embedded timestamp. END is exclusive and may be empty for end of file; negative offsets
+            count from the end. This avoids a normalizer pass over large binaries.
+        context_bytes: Number of bytes shown in the hexdump around the first difference.
+        max_regions: Maximum number of differing regions listed by offset.
+        batch: Compare all files of a test in one call instead of one call per file.
+        **kwargs: Extra attributes forwarded to `snapshot_comparator`.
+    """
+    tool_label = Label("//compare:binary")
+    args = ["--batch", "{MANIFEST}"] if batch else ["{SNAPSHOT}", "{OUTPUT}"]
+    for byte_range in ignore_ranges or []:
+        args.append("--ignore-range=" + byte_range)
+    if context_bytes != None:
+        args.extend(["--context", str(context_bytes)])
+    if max_regions != None:
+        args.extend(["--max-regions", str(max_regions)])
+
+    snapshot_comparator(
+        name = name,
+        executable = tool_label,
+        args = args,
+        batch = batch,
+        **kwargs
+    )
+
+
+def json_comparator(
+        name,
+        float_tolerance = None,
+        relative_tolerance = None,
+        ignore_paths = None,
+        max_differences = None,
+        batch = False,
+        **kwargs):
+    """Define a snapshot comparator that compares JSON documents structurally.
+
+    Key order and formatting are ignored, so no jq normalizer is needed to
+    sort keys. Differences are reported as JSON pointers.
+
+    Args:
+        name: Target name.
+        float_tolerance: Absolute difference below which numbers are considered equal.
+        relative_tolerance: Relative difference below which numbers are considered equal.
+        ignore_paths: List of JSON pointers to skip, such as "/meta/time"; "*" matches any key or index.
+        max_differences: Maximum number of differences reported per file.
+        batch: Compare all files of a test in one call instead of one call per file.
+        **kwargs: Extra attributes forwarded to `snapshot_comparator`.
+    """
+    def _escape_make(value):
+        return value.replace("$", "$$")
+    tool_label = Label("//compare:json")
+    args = ["--batch", "{MANIFEST}"] if batch else ["{SNAPSHOT}", "{OUTPUT}"]
+    if float_tolerance != None:
+        args.extend(["--float-tolerance", str(float_tolerance)])
+    if relative_tolerance != None:
+        args.extend(["--relative-tolerance", str(relative_tolerance)])
+    for pointer in ignore_paths or []:
+        args.extend(["--ignore-path", _escape_make(pointer)])
+    if max_differences != None:
+        args.extend(["--max-differences", str(max_differences)])
+
+    snapshot_comparator(
+        name = name,
+        executable = tool_label,
+        args = args,
+        batch = batch,
+        **kwargs
+    )
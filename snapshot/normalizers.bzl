@@ -41,6 +41,7 @@ def text_normalizer(
         name = name,
         executable = tool_label,
         args = args,
+        streaming = kwargs.pop("streaming", True),
         **kwargs
     )
 
@@ -85,5 +86,6 @@ def json_normalizer(
         args = norm_args,
         data = extra_data,
         stdout = True,
+        streaming = kwargs.pop("streaming", True),
         **kwargs
     )
@@ -0,0 +1,76 @@
+"""Local cache of snapshot files that previously passed, shared between test runs."""
+
+import os
+import shutil
+import tempfile
+
+
+class ResultCache:
+    """Stores the normalized output of passing files under a content-derived key.
+
+    Entries are written atomically and touched on every hit, so eviction can
+    drop the least recently used ones. Several test processes may share the
+    directory; an entry vanishing mid-lookup is treated as a miss.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key, destination):
+        """Writes the cached output for `key` to `destination`; returns False on a miss."""
+        entry = self._entry_path(key)
+        try:
+            os.utime(entry)
+            if os.path.lexists(destination):
+                os.remove(destination)
+            try:
+                os.link(entry, destination)
+            except OSError:
+                shutil.copyfile(entry, destination)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, source):
+        entry = self._entry_path(key)
+        parent = os.path.dirname(entry)
+        os.makedirs(parent, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=parent, prefix=".tmp-")
+        os.close(handle)
+        try:
+            shutil.copyfile(source, temp_path)
+            os.replace(temp_path, entry)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        for parent, _, files in os.walk(self.root):
+            for filename in files:
+                if filename.startswith(".tmp-"):
+                    continue
+                path = os.path.join(parent, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
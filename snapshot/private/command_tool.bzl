@@ -3,6 +3,17 @@ load("//snapshot/private:runfiles.bzl", "executable_runfile_path")
 def _rlocation(ctx, target):
     return executable_runfile_path(ctx, target)
 
+_BUILTIN_TOOLS = {
+    Label("//snapshot/private:text_normalizer"): "text_normalizer",
+    Label("//compare:text"): "text_compare",
+    Label("//compare:binary"): "binary_compare",
+    Label("//compare:json"): "json_compare",
+}
+
+def builtin_tool(target):
+    """Returns the name the runner uses to call `target` in-process, or None."""
+    return _BUILTIN_TOOLS.get(target.label)
+
 def _merge_runfiles(base, target):
     info = target[DefaultInfo]
     return base.merge(info.default_runfiles)
@@ -11,8 +22,25 @@ def _expand_value(ctx, value, deps):
     expanded = ctx.expand_make_variables(ctx.label.name, value, ctx.var)
     return ctx.expand_location(expanded, deps)
 
+_PERSISTENT_WORKER_DOC = """Keep the executable running for the whole test instead of launching it once per file.
+
+The executable is started with a single `--persistent_worker` argument and reads one JSON object per line on stdin, holding the
+expanded `args` and `env` for a file plus its `input`/`output` (normalizers) or `output`/`snapshot` (comparators) paths.
+It must answer each request with one JSON line on stdout, such as `{"exit_code": 0, "stdout": "", "stderr": ""}`.
+The runner may start several workers for the same tool to process files concurrently. A worker whose reply cannot be
+parsed is killed and the file fails; the next file starts a new worker.
+"""
+
+_BATCH_DOC = """Run the executable once for all files of the test instead of once per file.
+
+`args` and `env` are expanded once, with `{MANIFEST}` standing for a file that holds one JSON object per line with the
+`rel_path`, `output` and `snapshot` paths of a file to compare. The executable must write one JSON line per file to stdout,
+such as `{"rel_path": "...", "exit_code": 1, "stdout": "", "stderr": "<diff>"}`; files it reports nothing for fail.
+Compressed snapshots are passed decompressed. The built-in comparators accept `--batch {MANIFEST}`.
+"""
+
 SnapshotCommandInfo = provider(
-    fields = ["executable", "args", "env", "stdout"],
+    fields = ["executable", "args", "env", "stdout", "streaming", "builtin", "worker", "batch"],
 )
 
 def _snapshot_command_impl(ctx, allow_stdout):
@@ -28,6 +56,14 @@ def _snapshot_command_impl(ctx, allow_stdout):
         stdout = getattr(ctx.attr, "stdout")
     else:
         stdout = False
+    streaming = getattr(ctx.attr, "streaming", False)
+    batch = getattr(ctx.attr, "batch", False)
+    if stdout and ctx.attr.persistent_worker:
+        fail("{}: stdout and persistent_worker cannot both be set".format(ctx.label))
+    if batch and ctx.attr.persistent_worker:
+        fail("{}: batch and persistent_worker cannot both be set".format(ctx.label))
+    if batch and not [value for value in ctx.attr.args + ctx.attr.env.values() if "{MANIFEST}" in value]:
+        fail("{}: a batch comparator must pass {{MANIFEST}} in args or env".format(ctx.label))
 
     runfiles = ctx.runfiles()
     runfiles = _merge_runfiles(runfiles, ctx.attr.executable)
@@ -42,6 +78,10 @@ def _snapshot_command_impl(ctx, allow_stdout):
             args = args,
             env = env,
             stdout = stdout,
+            streaming = streaming,
+            builtin = builtin_tool(ctx.attr.executable),
+            worker = ctx.attr.persistent_worker,
+            batch = batch,
         ),
     ]
 
@@ -76,7 +116,15 @@ A normalizer can be used to remove unstable outputs or make a file easier to com
         ),
         "stdout": attr.bool(
             default = False,
-            doc = "Capture stdout and write it to the normalized output file.",
+            doc = "Capture stdout and write it to the normalized output file. Cannot be combined with `persistent_worker`, whose stdout carries its replies.",
+        ),
+        "streaming": attr.bool(
+            default = False,
+            doc = "The executable reads `{INPUT}` and writes `{OUTPUT}` (or stdout) front to back, without seeking or renaming. Adjacent streaming normalizers in a chain are connected with pipes instead of intermediate files.",
+        ),
+        "persistent_worker": attr.bool(
+            default = False,
+            doc = _PERSISTENT_WORKER_DOC,
         ),
     },
 )
@@ -101,5 +149,13 @@ snapshot_comparator = rule(
             allow_files = True,
             doc = "The list of files needed by this target at runtime",
         ),
+        "persistent_worker": attr.bool(
+            default = False,
+            doc = _PERSISTENT_WORKER_DOC,
+        ),
+        "batch": attr.bool(
+            default = False,
+            doc = _BATCH_DOC,
+        ),
     },
 )
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Writes a size and SHA-256 manifest for a test's snapshot files."""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from compare import compressed
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path, decompress=False):
+    digest, _ = _hash_stream(path, decompress)
+    return digest
+
+
+def _hash_stream(path, decompress):
+    digest = hashlib.sha256()
+    size = 0
+    with compressed.open_read(path, decompress) as handle:
+        while True:
+            chunk = handle.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def blob_path(sha256):
+    """Returns where a snapshot_store keeps the blob with this SHA-256, relative to the store."""
+    return "{}/{}".format(sha256[:2], sha256)
+
+
+def file_digest(path):
+    """Returns the size and SHA-256 of `path`.
+
+    A file with a compression suffix also gets a "content" digest of its
+    decompressed bytes, which is what outputs are matched against.
+    """
+    digest = {"size": os.path.getsize(path), "sha256": file_sha256(path)}
+    if compressed.codec_of(path) and (compressed.codec_of(path) != "zst" or compressed.zstd_available()):
+        try:
+            content_sha256, content_size = _hash_stream(path, True)
+        except Exception:  # pylint: disable=broad-except
+            # Not actually compressed, e.g. the snapshot of an output that is itself a .gz file.
+            return digest
+        digest["content"] = {"size": content_size, "sha256": content_sha256}
+    return digest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a snapshot digest manifest.",
+        fromfile_prefix_chars="@",
+    )
+    parser.add_argument("output", help="Path of the manifest to write.")
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="Alternating snapshot-relative paths and file paths.",
+    )
+    args = parser.parse_args()
+    if len(args.files) % 2:
+        parser.error("files must be given as REL_PATH PATH pairs")
+
+    manifest = {}
+    for rel_path, path in zip(args.files[::2], args.files[1::2]):
+        manifest[rel_path] = file_digest(path)
+    with open(args.output, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+        handle.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
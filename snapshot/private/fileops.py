@@ -0,0 +1,58 @@
+"""File copies that avoid duplicating data where the file system allows it."""
+
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request that clones a file's extents (Linux btrfs, XFS, ...).
+_FICLONE = 0x40049409
+_COPY_CHUNK = 64 * 1024 * 1024
+
+
+def copy_file(src, dst):
+    """Copies `src` to `dst`, sharing extents or copying in-kernel where supported."""
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(target.fileno(), _FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(source.fileno(), target.fileno(), _COPY_CHUNK):
+                    pass
+                return
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                source.seek(0)
+                target.seek(0)
+                target.truncate()
+        shutil.copyfileobj(source, target, _COPY_CHUNK)
+
+
+def link_or_copy(src, dst):
+    """Makes `dst` a hard link to `src`, or a clone or copy on another file system."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+
+def move_file(src, dst):
+    """Moves `src` to `dst`, copying only when they are on different file systems."""
+    try:
+        os.replace(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        copy_file(src, dst)
+        os.remove(src)
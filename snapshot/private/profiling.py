@@ -0,0 +1,158 @@
+"""Per-stage timing and resource usage for the snapshot runner."""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _rss_kb(maxrss):
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    if sys.platform == "darwin":
+        return maxrss // 1024
+    return maxrss
+
+
+class _Span:
+    def __init__(self, category, name, rel_path):
+        self.category = category
+        self.name = name
+        self.rel_path = rel_path
+        self.cpu = 0.0
+        self.max_rss_kb = None
+        self.bytes_in = None
+        self.bytes_out = None
+
+
+class Profile:
+    """Collects one event per runner stage, from any thread.
+
+    A span measures wall time and the CPU time of the calling thread, which
+    covers tools run in-process. Child processes waited for inside the span
+    add their own CPU time and peak RSS through add_child_usage, and pooled
+    processes the CPU time of their call through add_cpu. Persistent
+    workers are shared between files, so only their wall time is attributed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self._threads = {}
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, category, name, rel_path=None):
+        span = _Span(category, name, rel_path)
+        previous = getattr(self._local, "span", None)
+        self._local.span = span
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield span
+        finally:
+            wall = time.perf_counter() - start
+            span.cpu += time.thread_time() - cpu_start
+            self._local.span = previous
+            self._record(span, start, wall)
+
+    def add_cpu(self, seconds):
+        """Attributes CPU time spent in another process on the current span's behalf."""
+        span = getattr(self._local, "span", None)
+        if span is not None:
+            span.cpu += seconds
+
+    def add_child_usage(self, usage):
+        """Attributes the rusage of a reaped child process to the current span."""
+        span = getattr(self._local, "span", None)
+        if span is None:
+            return
+        span.cpu += usage.ru_utime + usage.ru_stime
+        span.max_rss_kb = max(span.max_rss_kb or 0, _rss_kb(usage.ru_maxrss))
+
+    def _record(self, span, start, wall):
+        event = {
+            "category": span.category,
+            "name": span.name,
+            "file": span.rel_path,
+            "start_s": round(start - self._origin, 6),
+            "wall_s": round(wall, 6),
+            "cpu_s": round(span.cpu, 6),
+            "max_rss_kb": span.max_rss_kb,
+            "bytes_in": span.bytes_in,
+            "bytes_out": span.bytes_out,
+        }
+        with self._lock:
+            event["thread"] = self._threads.setdefault(threading.get_ident(), len(self._threads))
+            self.events.append(event)
+
+    def totals(self):
+        """Sums events per (category, name), slowest first."""
+        totals = {}
+        for event in self.events:
+            key = (event["category"], event["name"])
+            total = totals.setdefault(
+                key,
+                {
+                    "category": event["category"],
+                    "name": event["name"],
+                    "count": 0,
+                    "wall_s": 0.0,
+                    "cpu_s": 0.0,
+                    "max_rss_kb": None,
+                    "bytes_in": 0,
+                    "bytes_out": 0,
+                },
+            )
+            total["count"] += 1
+            total["wall_s"] += event["wall_s"]
+            total["cpu_s"] += event["cpu_s"]
+            if event["max_rss_kb"] is not None:
+                total["max_rss_kb"] = max(total["max_rss_kb"] or 0, event["max_rss_kb"])
+            total["bytes_in"] += event["bytes_in"] or 0
+            total["bytes_out"] += event["bytes_out"] or 0
+        for total in totals.values():
+            total["wall_s"] = round(total["wall_s"], 6)
+            total["cpu_s"] = round(total["cpu_s"], 6)
+        return sorted(totals.values(), key=lambda total: -total["wall_s"])
+
+    def write(self, path):
+        with self._lock:
+            self.events.sort(key=lambda event: event["start_s"])
+        profile = {
+            "wall_s": round(time.perf_counter() - self._origin, 6),
+            "peak_rss_kb": _rss_kb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) if resource else None,
+            "totals": self.totals(),
+            "events": self.events,
+        }
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(profile, handle, indent=2)
+            handle.write("\n")
+
+    def write_trace(self, path):
+        """Writes the events in Chrome trace-event format (chrome://tracing, Perfetto)."""
+        events = []
+        for event in self.events:
+            args = {key: event[key] for key in ("file", "cpu_s", "max_rss_kb", "bytes_in", "bytes_out")}
+            events.append(
+                {
+                    "name": event["name"],
+                    "cat": event["category"],
+                    "ph": "X",
+                    "ts": int(event["start_s"] * 1e6),
+                    "dur": int(event["wall_s"] * 1e6),
+                    "pid": os.getpid(),
+                    "tid": event["thread"],
+                    "args": args,
+                }
+            )
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, handle)
+            handle.write("\n")
@@ -1,33 +1,127 @@
 #!/usr/bin/env python3
 """Shared runner that executes tests and compares outputs against snapshots."""
 
-import glob
+import concurrent.futures
+import functools
+import hashlib
+import io
 import json
+import multiprocessing
 import os
+import re
 import shutil
+import signal
 import subprocess
 import sys
-import xml.etree.ElementTree as ET
+import tempfile
+import threading
+import time
+from xml.sax import saxutils
 
+from compare import binary as binary_compare
+from compare import compressed
+from compare import json_diff as json_compare
+from compare import text as text_compare
 from python.runfiles import runfiles
+from snapshot.private import cache
+from snapshot.private import digests
+from snapshot.private import fileops
+from snapshot.private import profiling
+from snapshot.private import text_normalizer
+
+# Tools shipped with this repository are imported and called directly instead
+# of paying interpreter startup for every file, in a pool of worker processes
+# when several files are checked at once. Keys match `builtin_tool` in
+# command_tool.bzl.
+_BUILTIN_TOOLS = {
+    "text_normalizer": text_normalizer.run,
+    "text_compare": text_compare.run,
+    "binary_compare": binary_compare.run,
+    "json_compare": json_compare.run,
+}
+
+_DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Failure output embedded in the JUnit report, per failure and in total.
+# Longer output is cut; the full text stays in results/<path>.log.
+_DEFAULT_JUNIT_MAX_FAILURE_BYTES = 64 * 1024
+_DEFAULT_JUNIT_MAX_BYTES = 16 * 1024 * 1024
+
+# Characters XML 1.0 cannot represent, even escaped.
+_XML_INVALID = re.compile("[^\u0009\u000a\u000d\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+_SHARD_ENV_VARS = ["TEST_TOTAL_SHARDS", "TEST_SHARD_INDEX", "TEST_SHARD_STATUS_FILE"]
+
+# Streaming normalizer stages are connected with pipes passed as /dev/fd paths.
+_PIPES_SUPPORTED = os.name == "posix" and os.path.isdir("/dev/fd")
+
+_PROFILE = profiling.Profile()
+
+_MAX_UNMATCHED_LISTED = 20
+
+# Placeholders in tool args and env values, such as {INPUT} and {SNAPSHOT}.
+_TOKEN = re.compile(r"(\{[A-Z_]+\})")
+
+# Tools are started with posix_spawn where available, which skips the
+# Python-level fork bookkeeping of subprocess.Popen.
+_POSIX_SPAWN = hasattr(os, "posix_spawn") and hasattr(os, "wait4")
+
+# Python ignores these signals, and ignored signals are inherited. Tools get
+# them back at their defaults, as restore_signals does for subprocess.Popen.
+_RESTORED_SIGNALS = tuple(getattr(signal, name) for name in ("SIGPIPE", "SIGXFSZ") if hasattr(signal, name))
+
+# How often the ready file of a streaming test is polled for new lines.
+_READY_POLL_SECONDS = 0.05
 
 
 def main():
     runfiles_ctx = runfiles.Create()
     config = load_config(runfiles_ctx)
     base_dir = resolve_base_dir()
-    raw_dir, normalized_dir, results_dir = prepare_output_dirs(base_dir)
+    raw_dir, normalized_dir, results_dir = prepare_output_dirs(base_dir, config.get("keep_raw", True))
+    shard = resolve_shard()
+    accept = resolve_accept()
     test_env = build_test_env(config["test_env"], raw_dir)
-    run_wrapped_test(runfiles_ctx, config, test_env)
-    total, failures, results = process_outputs(
-        runfiles_ctx,
-        config,
-        raw_dir,
-        normalized_dir,
-        results_dir,
+    if shard and not config.get("shard_outputs"):
+        # Every shard runs the whole wrapped test; only the checking is split.
+        for key in _SHARD_ENV_VARS:
+            test_env.pop(key, None)
+    junit = open_junit_report(config)
+    checker = None
+    if resolve_stream(config, shard):
+        checker = OutputChecker(runfiles_ctx, config, raw_dir, normalized_dir, results_dir, accept)
+    try:
+        if checker:
+            run_streaming_test(runfiles_ctx, config, test_env, raw_dir, checker)
+        else:
+            run_wrapped_test(runfiles_ctx, config, test_env)
+        total, failures, results = process_outputs(
+            runfiles_ctx,
+            config,
+            raw_dir,
+            normalized_dir,
+            results_dir,
+            shard=shard,
+            accept=accept,
+            checker=checker,
+            junit=junit,
+        )
+    finally:
+        if checker:
+            checker.close()
+    if accept:
+        print("[snapshot] accept mode: wrote {} normalized outputs without comparing".format(total))
+    if junit:
+        junit.close()
+    write_output_manifest(
+        base_dir,
+        results,
+        shard,
+        config.get("snapshot_compression") or None,
+        config.get("snapshot_store_root"),
     )
-    write_junit_report(config, results)
-    print_failure_summary(failures, total)
+    write_profile(base_dir)
+    print_failure_summary(failures, total, sum(result["status"] == "skipped" for result in results))
     if failures:
         sys.exit(1)
 
@@ -46,8 +140,14 @@ def resolve_base_dir():
     return base_dir
 
 
-def prepare_output_dirs(base_dir):
-    raw_dir = os.path.join(base_dir, "raw")
+def prepare_output_dirs(base_dir, keep_raw=True):
+    if keep_raw:
+        raw_dir = os.path.join(base_dir, "raw")
+    else:
+        # Outside the undeclared outputs, so Bazel does not archive a second copy.
+        tmp_dir = os.environ.get("TEST_TMPDIR") or tempfile.mkdtemp(prefix="snapshot_")
+        raw_dir = os.path.join(tmp_dir, "snapshot_raw")
+        shutil.rmtree(raw_dir, ignore_errors=True)
     normalized_dir = os.path.join(base_dir, "normalized")
     results_dir = os.path.join(base_dir, "results")
     os.makedirs(raw_dir, exist_ok=True)
@@ -55,6 +155,19 @@ def prepare_output_dirs(base_dir):
     return raw_dir, normalized_dir, results_dir
 
 
+def resolve_shard():
+    """Returns (index, total) when Bazel runs this test sharded, else None."""
+    total = int(os.environ.get("TEST_TOTAL_SHARDS") or 0)
+    if total <= 1:
+        return None
+    index = int(os.environ.get("TEST_SHARD_INDEX") or 0)
+    status_file = os.environ.get("TEST_SHARD_STATUS_FILE")
+    if status_file:
+        with open(status_file, "a", encoding="utf-8"):
+            pass
+    return index, total
+
+
 def build_test_env(config_env, raw_dir):
     env = os.environ.copy()
     env.update(config_env)
@@ -66,86 +179,778 @@ def build_test_env(config_env, raw_dir):
 def run_wrapped_test(runfiles_ctx, config, env):
     test_path = rlocation(runfiles_ctx, config["test_runfile"])
     test_cmd = [test_path] + config["test_args"]
-    result = subprocess.run(test_cmd, env=env)
-    if result.returncode != 0:
-        sys.exit("[snapshot] wrapped test exited with {}".format(result.returncode))
+    with _PROFILE.span("test", config["test_runfile"]) as span:
+        returncode = _wait_process(subprocess.Popen(test_cmd, env=env))
+        span.bytes_out = _tree_size(env["SNAPSHOT_OUTPUTS_DIR"])
+    if returncode != 0:
+        sys.exit("[snapshot] wrapped test exited with {}".format(returncode))
+
+
+def resolve_stream(config, shard):
+    """Returns True if outputs should be checked while the wrapped test runs.
+
+    Sharding split by the runner deals out the sorted list of all outputs,
+    which is only known once the test exits, so it disables streaming.
+    """
+    if not config.get("stream_outputs"):
+        return False
+    return not shard or bool(config.get("shard_outputs"))
+
+
+def run_streaming_test(runfiles_ctx, config, env, raw_dir, checker):
+    """Runs the wrapped test, checking each output as soon as the test reports it done.
+
+    The test appends the path of every finished output, relative to
+    SNAPSHOT_OUTPUTS_DIR, as one line to the file named by
+    SNAPSHOT_READY_FILE. Reported files must not change afterwards. Files
+    that are never reported are checked after the test exits.
+    """
+    handle, ready_path = tempfile.mkstemp(prefix="snapshot_ready_", dir=os.environ.get("TEST_TMPDIR"))
+    os.close(handle)
+    env = dict(env)
+    env["SNAPSHOT_READY_FILE"] = ready_path
+
+    def on_ready(rel_path):
+        file_map = assign_formats(raw_dir, config["formats"], allow_missing=True, files=[rel_path])
+        for matched_path, format_cfg in file_map.items():
+            checker.submit(matched_path, format_cfg)
+
+    watcher = ReadyFileWatcher(ready_path, raw_dir, on_ready)
+    watcher.start()
+    try:
+        run_wrapped_test(runfiles_ctx, config, env)
+    finally:
+        watcher.stop()
+        os.remove(ready_path)
+
+
+class ReadyFileWatcher:
+    """Tails a ready file on a background thread, reporting each listed output once."""
+
+    def __init__(self, path, raw_dir, callback):
+        self._path = path
+        self._raw_dir = raw_dir
+        self._callback = callback
+        self._seen = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="snapshot-ready", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Reports the lines written so far, then stops."""
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        pending = b""
+        with open(self._path, "rb") as handle:
+            while True:
+                stopping = self._stop.is_set()
+                chunk = handle.read()
+                if chunk:
+                    lines = (pending + chunk).split(b"\n")
+                    pending = lines.pop()
+                    for line in lines:
+                        self._report(line)
+                elif stopping:
+                    # A final line without a newline may still be incomplete;
+                    # that file is checked after the test like any other.
+                    return
+                else:
+                    self._stop.wait(_READY_POLL_SECONDS)
 
+    def _report(self, line):
+        path = os.fsdecode(line.strip())
+        if not path:
+            return
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self._raw_dir)
+        rel_path = os.path.normpath(path)
+        if rel_path in self._seen or rel_path.startswith(os.pardir) or os.path.isabs(rel_path):
+            return
+        self._seen.add(rel_path)
+        if not os.path.isfile(os.path.join(self._raw_dir, rel_path)):
+            return
+        try:
+            self._callback(rel_path)
+        except Exception as exc:  # pylint: disable=broad-except
+            print("[snapshot] could not check {} early: {}".format(rel_path, exc), file=sys.stderr)
 
-def process_outputs(runfiles_ctx, config, raw_dir, normalized_dir, results_dir):
-    file_map = assign_formats(raw_dir, config["formats"])
+
+def _tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return total
+
+
+def process_outputs(
+    runfiles_ctx,
+    config,
+    raw_dir,
+    normalized_dir,
+    results_dir,
+    shard=None,
+    accept=False,
+    checker=None,
+    junit=None,
+):
+    """Checks every produced output; returns (total, failures, results).
+
+    Files already submitted to `checker` while the test ran are not checked
+    again. Results are reported in path order either way, and added to
+    `junit` as they come in. Files compared by a batch comparator, and all
+    files after the first of them, are reported once the batch comparators
+    have run; with a failure limit, those run a window of files at a time. Neither `failures` nor `results` keep the failure output; it
+    is printed, logged under results/, and embedded in the JUnit report up
+    to its size limits.
+    """
+    # When the wrapped test shards its own outputs, files missing here were
+    # produced by another shard.
+    test_shards = bool(shard) and config.get("shard_outputs")
+    files = index_outputs(raw_dir)
+    if checker:
+        # A streamed passthrough output may already have been moved out of
+        # raw/; it still counts as produced, and its result must be collected.
+        files = sorted(set(files).union(checker.submitted()))
+    file_map = assign_formats(raw_dir, config["formats"], allow_missing=test_shards, files=files)
+    report_unmatched(config.get("unmatched_outputs"), files, file_map)
+    if shard and not test_shards:
+        file_map = shard_files(file_map, *shard)
     if not file_map:
+        if shard:
+            print("[snapshot] no files to check in shard {} of {}".format(shard[0] + 1, shard[1]))
+            return 0, [], []
         sys.exit("[snapshot] no files matched the configured outputs")
+    owns_checker = checker is None
+    if owns_checker:
+        checker = OutputChecker(runfiles_ctx, config, raw_dir, normalized_dir, results_dir, accept)
 
     failures = []
     results = []
-    for rel_path, format_cfg in sorted(file_map.items()):
-        display_name = format_cfg["display_name"]
-        raw_path = os.path.join(raw_dir, rel_path)
-        normalized_path = os.path.join(normalized_dir, rel_path)
-        parent = os.path.dirname(normalized_path)
-        if parent:
-            os.makedirs(parent, exist_ok=True)
-        snapshot_path = resolve_snapshot_path(runfiles_ctx, config, rel_path)
-        normalize_ok, normalize_result = run_normalizers(
-            runfiles_ctx,
-            raw_path,
-            normalized_path,
-            format_cfg["normalize"],
+    items = sorted(file_map.items())
+    # With a failure limit, only a window of files is queued ahead, so that
+    # little work is left to cancel once the limit is reached.
+    ahead = checker.window or len(items)
+    futures = []
+    # Outcomes waiting for the batch comparators, held back to keep path order.
+    held = []
+    try:
+        # Collected in submission order, so output stays sorted by rel_path.
+        for index, (rel_path, format_cfg) in enumerate(items):
+            while len(futures) < min(index + ahead, len(items)):
+                futures.append(checker.submit(*items[len(futures)]))
+            try:
+                outcome = futures[index].result() if futures[index] else None
+            except concurrent.futures.CancelledError:
+                outcome = None
+            futures[index] = None
+            if outcome is None:
+                outcome = (rel_path, format_cfg, None, None)
+                skipped = True
+            else:
+                skipped = False
+            if held or isinstance(outcome[2], PendingComparison):
+                held.append((outcome, skipped))
+                continue
+            _report_outcome(outcome, skipped, results, failures, junit)
+        pending = [outcome[2] for outcome, _ in held if isinstance(outcome[2], PendingComparison)]
+        compared = {}
+        # With a failure limit, batch comparators get a window of files per
+        # call, so that checking stops soon after the limit is reached.
+        chunk = checker.window or max(len(pending), 1)
+        for start in range(0, len(pending), chunk):
+            if checker.stopped:
+                break
+            batch_failures = run_batch_comparisons(
+                runfiles_ctx,
+                pending[start:start + chunk],
+                results_dir,
+                checker.result_cache,
+            )
+            compared.update(batch_failures)
+            checker.record_failures(sum(1 for failure in batch_failures.values() if failure))
+        for outcome, skipped in held:
+            if isinstance(outcome[2], PendingComparison):
+                # Comparisons still pending once the failure limit is reached are skipped.
+                skipped = outcome[0] not in compared
+                outcome = (outcome[0], outcome[1], compared.get(outcome[0]), outcome[3])
+            _report_outcome(outcome, skipped, results, failures, junit)
+    finally:
+        if owns_checker:
+            checker.close()
+    if checker.result_cache:
+        checker.result_cache.evict()
+    return len(file_map), failures, results
+
+
+def _report_outcome(outcome, skipped, results, failures, junit):
+    rel_path, format_cfg, failure, elapsed = outcome
+    result = _build_result(rel_path, format_cfg["display_name"], failure, elapsed, skipped)
+    results.append(result)
+    if junit:
+        junit.add(result, failure)
+    if failure:
+        _print_failure(failure)
+        failures.append({key: failure[key] for key in ("rel_path", "display_name", "failure_kind")})
+        # The checker still holds the future with this dict; once reported,
+        # the output must not stay in memory for the rest of the run.
+        failure.pop("stdout", None)
+        failure.pop("stderr", None)
+
+
+class OutputChecker:
+    """Runs process_file for output files on a thread pool, each file at most once.
+
+    Files may be submitted from any thread, including while the wrapped test
+    is still running. Once `resolve_max_failures` failures have completed,
+    queued files are cancelled and submit() returns None for new ones;
+    files already being checked run to completion.
+    """
+
+    def __init__(self, runfiles_ctx, config, raw_dir, normalized_dir, results_dir, accept=False):
+        self._runfiles_ctx = runfiles_ctx
+        self._config = config
+        self._raw_dir = raw_dir
+        self._normalized_dir = normalized_dir
+        self._results_dir = results_dir
+        self._accept = accept
+        self._snapshot_digests = load_snapshot_digests(runfiles_ctx, config)
+        # Accepted outputs were never compared, so they must not be cached as passing.
+        self.result_cache = None if accept else resolve_cache()
+        jobs = resolve_jobs(config)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        _BUILTIN_PROCESSES.start(jobs)
+        self._max_failures = resolve_max_failures(config)
+        self.window = 2 * jobs if self._max_failures else None
+        self._failures = 0
+        self.stopped = False
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def submit(self, rel_path, format_cfg):
+        """Queues a file; returns its future, or None if checking has stopped."""
+        with self._lock:
+            future = self._futures.get(rel_path)
+            if future is not None:
+                return future
+            if self.stopped:
+                return None
+            future = self._executor.submit(
+                process_file,
+                self._runfiles_ctx,
+                self._config,
+                self._snapshot_digests,
+                self.result_cache,
+                rel_path,
+                format_cfg,
+                self._raw_dir,
+                self._normalized_dir,
+                self._results_dir,
+                self._accept,
+            )
+            self._futures[rel_path] = future
+        if self._max_failures:
+            # Outside the lock: the callback runs right away if the file is already done.
+            future.add_done_callback(self._count_failure)
+        return future
+
+    def submitted(self):
+        """Returns the relative paths of every file submitted so far."""
+        with self._lock:
+            return list(self._futures)
+
+    def _count_failure(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        failure = future.result()[2]
+        if failure is None or isinstance(failure, PendingComparison):
+            return
+        self.record_failures(1)
+
+    def record_failures(self, count):
+        """Counts failed files, including those checked outside the pool by batch comparators."""
+        if not self._max_failures or not count:
+            return
+        with self._lock:
+            self._failures += count
+            if self._failures < self._max_failures or self.stopped:
+                return
+            self.stopped = True
+            pending = list(self._futures.values())
+        print("[snapshot] stopping after {} failed files".format(self._failures), file=sys.stderr)
+        for queued in pending:
+            queued.cancel()
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+        _WORKERS.shutdown()
+        _BUILTIN_PROCESSES.shutdown()
+
+
+def process_file(
+    runfiles_ctx,
+    config,
+    snapshot_digests,
+    result_cache,
+    rel_path,
+    format_cfg,
+    raw_dir,
+    normalized_dir,
+    results_dir,
+    accept=False,
+):
+    """Checks one output file; returns (rel_path, format_cfg, failure, elapsed_seconds).
+
+    `failure` is a PendingComparison when a batch comparator still has to run.
+    """
+    start = time.perf_counter()
+    raw_path = os.path.join(raw_dir, rel_path)
+    normalized_path = os.path.join(normalized_dir, rel_path)
+    parent = os.path.dirname(normalized_path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    snapshot_rel, snapshot_digest = resolve_snapshot_entry(snapshot_digests, rel_path)
+    snapshot_path = resolve_snapshot_path(runfiles_ctx, config, snapshot_rel, snapshot_digest)
+    cache_key = None
+    if result_cache:
+        cache_key = result_cache_key(runfiles_ctx, format_cfg, raw_path, snapshot_path, snapshot_digest)
+        if cache_key and _cache_restore(result_cache, cache_key, normalized_path):
+            return rel_path, format_cfg, None, time.perf_counter() - start
+    failure = check_file(
+        runfiles_ctx,
+        format_cfg,
+        snapshot_digest,
+        rel_path,
+        raw_path,
+        normalized_path,
+        snapshot_path,
+        results_dir,
+        accept,
+        config.get("keep_raw", True),
+        snapshot_rel != rel_path.replace(os.sep, "/"),
+    )
+    if isinstance(failure, PendingComparison):
+        failure.cache_key = cache_key
+    elif failure is None and cache_key:
+        _cache_store(result_cache, cache_key, normalized_path)
+    return rel_path, format_cfg, failure, time.perf_counter() - start
+
+
+def check_file(
+    runfiles_ctx,
+    format_cfg,
+    snapshot_digest,
+    rel_path,
+    raw_path,
+    normalized_path,
+    snapshot_path,
+    results_dir,
+    accept=False,
+    keep_raw=True,
+    snapshot_compressed=False,
+):
+    """Normalizes one output and compares it to its snapshot; returns the failure or None.
+
+    With `accept`, the comparison is skipped and only the normalized output is written.
+    For a batch comparator, a PendingComparison is returned instead of comparing.
+    `snapshot_compressed` means `snapshot_path` is stored with a compression suffix.
+    """
+    display_name = format_cfg["display_name"]
+    normalize_ok, normalize_result = run_normalizers(
+        runfiles_ctx,
+        raw_path,
+        normalized_path,
+        format_cfg["normalize"],
+        rel_path,
+        display_name,
+        results_dir,
+        keep_raw,
+    )
+    if not normalize_ok:
+        return normalize_result
+    if accept:
+        return None
+    if snapshot_digest:
+        with _PROFILE.span("digest", "sha256", rel_path) as span:
+            span.bytes_in = snapshot_digest["size"]
+            matched = matches_digest(normalized_path, snapshot_digest)
+        if matched:
+            return None
+    if format_cfg["compare"].get("batch"):
+        return PendingComparison(
             rel_path,
             display_name,
-            results_dir,
-        )
-        if not normalize_ok:
-            failures.append(normalize_result)
-            results.append(_build_result(rel_path, display_name, normalize_result))
-            _print_failure(normalize_result)
-            continue
-        compare_ok, compare_result = run_comparator(
-            runfiles_ctx,
-            format_cfg,
+            format_cfg["compare"],
             normalized_path,
             snapshot_path,
-            rel_path,
-            display_name,
-            results_dir,
+            snapshot_compressed,
         )
-        if compare_ok:
-            results.append(_build_result(rel_path, display_name, None))
+    compare_ok, compare_result = run_comparator(
+        runfiles_ctx,
+        format_cfg,
+        normalized_path,
+        snapshot_path,
+        rel_path,
+        display_name,
+        results_dir,
+        snapshot_compressed,
+    )
+    if not compare_ok:
+        return compare_result
+    return None
+
+
+def resolve_accept():
+    """Returns True if SNAPSHOT_ACCEPT asks to write normalized outputs without comparing them."""
+    return _env_flag("SNAPSHOT_ACCEPT")
+
+
+def _env_flag(name):
+    return os.environ.get(name, "").lower() not in ("", "0", "false", "no")
+
+
+def resolve_cache():
+    cache_dir = os.environ.get("SNAPSHOT_CACHE_DIR")
+    if not cache_dir:
+        return None
+    max_bytes = os.environ.get("SNAPSHOT_CACHE_MAX_BYTES") or _DEFAULT_CACHE_MAX_BYTES
+    try:
+        max_bytes = int(max_bytes)
+    except ValueError:
+        sys.exit("[snapshot] SNAPSHOT_CACHE_MAX_BYTES must be an integer, got {!r}".format(max_bytes))
+    return cache.ResultCache(cache_dir, max_bytes)
+
+
+def result_cache_key(runfiles_ctx, format_cfg, raw_path, snapshot_path, snapshot_digest):
+    """Returns the cache key for a file, or None if the snapshot cannot be identified."""
+    if snapshot_digest:
+        snapshot_sha256 = snapshot_digest["sha256"]
+    elif os.path.isfile(snapshot_path):
+        snapshot_sha256 = digests.file_sha256(snapshot_path)
+    else:
+        return None
+    tools = list(format_cfg["normalize"]) + [format_cfg["compare"]]
+    key = {
+        "raw": digests.file_sha256(raw_path),
+        "normalize": format_cfg["normalize"],
+        "compare": format_cfg["compare"],
+        "tools": [_tool_fingerprint(runfiles_ctx, tool) for tool in tools],
+        "snapshot": snapshot_sha256,
+    }
+    encoded = json.dumps(key, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _tool_fingerprint(runfiles_ctx, tool):
+    builtin = _BUILTIN_TOOLS.get(tool.get("builtin"))
+    if builtin:
+        path = sys.modules[builtin.__module__].__file__
+    else:
+        path = _tool_path(runfiles_ctx, tool["executable"])
+    return _file_fingerprint(os.path.realpath(path))
+
+
+@functools.lru_cache(maxsize=None)
+def _file_fingerprint(path):
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def _cache_restore(result_cache, key, normalized_path):
+    try:
+        return result_cache.restore(key, normalized_path)
+    except OSError as exc:
+        print("[snapshot] ignoring cache error: {}".format(exc), file=sys.stderr)
+        return False
+
+
+def _cache_store(result_cache, key, normalized_path):
+    try:
+        result_cache.store(key, normalized_path)
+    except OSError as exc:
+        print("[snapshot] ignoring cache error: {}".format(exc), file=sys.stderr)
+
+
+def load_snapshot_digests(runfiles_ctx, config):
+    key = config.get("snapshot_digests")
+    if not key:
+        return {}
+    with open(rlocation(runfiles_ctx, key), "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def matches_digest(path, expected):
+    """Returns True if `path` is byte-identical to the snapshot described by `expected`."""
+    if not expected:
+        return False
+    try:
+        if os.path.getsize(path) != expected["size"]:
+            return False
+    except OSError:
+        return False
+    return digests.file_sha256(path) == expected["sha256"]
+
+
+def resolve_jobs(config):
+    value = os.environ.get("SNAPSHOT_JOBS") or config.get("jobs") or 0
+    try:
+        jobs = int(value)
+    except ValueError:
+        sys.exit("[snapshot] SNAPSHOT_JOBS must be an integer, got {!r}".format(value))
+    if jobs > 0:
+        return jobs
+    return available_cpus()
+
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def resolve_max_failures(config):
+    """Returns how many failed files stop the run, or 0 for no limit.
+
+    SNAPSHOT_FAIL_FAST and SNAPSHOT_MAX_FAILURES override the rule's
+    `fail_fast` and `max_failures`; fail-fast means a limit of 1.
+    """
+    if _env_flag("SNAPSHOT_FAIL_FAST") or (config.get("fail_fast") and "SNAPSHOT_FAIL_FAST" not in os.environ):
+        return 1
+    value = os.environ.get("SNAPSHOT_MAX_FAILURES") or config.get("max_failures") or 0
+    try:
+        limit = int(value)
+    except ValueError:
+        sys.exit("[snapshot] SNAPSHOT_MAX_FAILURES must be an integer, got {!r}".format(value))
+    return max(limit, 0)
+
+
+def shard_files(file_map, index, total):
+    """Returns the files checked by shard `index`, dealing sorted paths round-robin."""
+    return {
+        rel_path: format_cfg
+        for position, (rel_path, format_cfg) in enumerate(sorted(file_map.items()))
+        if position % total == index
+    }
+
+
+def index_outputs(raw_dir):
+    """Returns the relative paths of every regular file under `raw_dir`, walking it once.
+
+    Like glob, symlinks to files and directories are followed; a directory
+    link that points back into its own ancestry is not descended.
+    """
+    files = []
+    pending = [(raw_dir, "")]
+    while pending:
+        directory, prefix = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            rel = prefix + entry.name
+            try:
+                if entry.is_dir():
+                    if entry.is_symlink() and _is_link_cycle(entry.path):
+                        continue
+                    pending.append((entry.path, rel + os.sep))
+                elif entry.is_file():
+                    files.append(rel)
+            except OSError:
+                continue
+    files.sort()
+    return files
+
+
+def _is_link_cycle(path):
+    target = os.path.realpath(path)
+    parent = os.path.realpath(os.path.dirname(path))
+    return parent == target or parent.startswith(target.rstrip(os.sep) + os.sep)
+
+
+def _compile_pattern(pattern):
+    """Translates a recursive glob pattern into a regex over "/"-separated paths.
+
+    Follows glob.glob(recursive=True): `*`, `?` and `[...]` never cross a
+    path separator or match a leading dot unless the pattern component starts
+    with one, and a `**` component spans any number of non-hidden
+    components. Returns None for patterns that can only name directories.
+    """
+    parts = pattern.replace(os.sep, "/").split("/")
+    if parts[-1] in ("", "."):
+        return None
+    parts = [part for part in parts if part not in ("", ".")]
+    pieces = []
+    for position, part in enumerate(parts):
+        last = position == len(parts) - 1
+        if part == "**":
+            if pieces and pieces[-1] == _RECURSIVE_DIRS:
+                if last:
+                    pieces[-1] = _RECURSIVE_FILES
+                continue
+            pieces.append(_RECURSIVE_FILES if last else _RECURSIVE_DIRS)
+            continue
+        part = os.path.normcase(part)
+        if _is_glob(part):
+            piece = _translate_component(part)
+            if not part.startswith("."):
+                piece = r"(?!\.)" + piece
         else:
-            failures.append(compare_result)
-            results.append(_build_result(rel_path, display_name, compare_result))
-            _print_failure(compare_result)
-    return len(file_map), failures, results
+            piece = re.escape(part)
+        pieces.append(piece + ("" if last else "/"))
+    return "".join(pieces)
 
 
-def assign_formats(raw_dir, formats):
-    mapping = {}
+# `**` before another component matches zero or more directories; at the end
+# it matches one or more components, since glob only lists inside directories.
+_RECURSIVE_DIRS = r"(?:(?!\.)[^/]+/)*"
+_RECURSIVE_FILES = r"(?!\.)[^/]+(?:/(?!\.)[^/]+)*"
+
+
+def _translate_component(part):
+    """Like fnmatch.translate for one path component, without crossing "/"."""
+    pieces = []
+    index = 0
+    length = len(part)
+    while index < length:
+        char = part[index]
+        index += 1
+        if char == "*":
+            if not pieces or pieces[-1] != "[^/]*":
+                pieces.append("[^/]*")
+        elif char == "?":
+            pieces.append("[^/]")
+        elif char == "[":
+            end = index
+            if end < length and part[end] == "!":
+                end += 1
+            if end < length and part[end] == "]":
+                end += 1
+            while end < length and part[end] != "]":
+                end += 1
+            if end >= length:
+                pieces.append("\\[")
+                continue
+            pieces.append(_translate_class(part[index:end]))
+            index = end + 1
+        else:
+            pieces.append(re.escape(char))
+    return "".join(pieces)
+
+
+def _translate_class(body):
+    """Translates the inside of a [...] group as fnmatch does, never matching "/"."""
+    if "-" not in body:
+        escaped = body.replace("\\", "\\\\")
+    else:
+        # Split around range hyphens and drop reversed ranges, which re rejects.
+        chunks = []
+        start = 0
+        search = 2 if body.startswith("!") else 1
+        while True:
+            found = body.find("-", search)
+            if found < 0:
+                break
+            chunks.append(body[start:found])
+            start = found + 1
+            search = found + 3
+        chunk = body[start:]
+        if chunk:
+            chunks.append(chunk)
+        else:
+            chunks[-1] += "-"
+        for position in range(len(chunks) - 1, 0, -1):
+            if chunks[position - 1][-1] > chunks[position][0]:
+                chunks[position - 1] = chunks[position - 1][:-1] + chunks[position][1:]
+                del chunks[position]
+        escaped = "-".join(chunk.replace("\\", "\\\\").replace("-", "\\-") for chunk in chunks)
+    escaped = re.sub(r"([&~|])", r"\\\1", escaped)
+    if not escaped:
+        return "(?!)"
+    if escaped == "!":
+        return "[^/]"
+    if escaped[0] == "!":
+        return "[^" + escaped[1:] + "/]"
+    if escaped[0] in ("^", "["):
+        escaped = "\\" + escaped
+    return "(?!/)[" + escaped + "]"
+
+
+def assign_formats(raw_dir, formats, allow_missing=False, files=None):
+    """Maps each produced file to the first format with a matching pattern.
+
+    `files` is the result of index_outputs(raw_dir), which is computed here
+    if not given. All patterns are combined into one regex, tried in order,
+    so each file is matched once.
+    """
+    if files is None:
+        files = index_outputs(raw_dir)
+    patterns = []
+    alternatives = []
     for format_cfg in formats:
         for pattern in format_cfg["patterns"]:
-            abs_pattern = os.path.join(raw_dir, pattern)
-            matches = glob.glob(abs_pattern, recursive=True)
-            if not matches:
-                if _is_glob(pattern):
-                    continue
-                msg = "[snapshot] expected file {} was not produced".format(pattern)
-                print(msg, file=sys.stderr)
-                sys.exit(msg)
-            for path in matches:
-                if not os.path.isfile(path):
-                    continue
-                rel = os.path.relpath(path, raw_dir)
-                if rel in mapping:
-                    continue
-                mapping[rel] = format_cfg
+            regex = _compile_pattern(pattern)
+            if regex is not None:
+                alternatives.append("(?P<p{}>{})".format(len(patterns), regex))
+            patterns.append((pattern, format_cfg))
+    mapping = {}
+    matched_patterns = set()
+    if alternatives:
+        matcher = re.compile("|".join(alternatives), re.DOTALL).fullmatch
+        for rel in files:
+            match = matcher(os.path.normcase(rel).replace(os.sep, "/"))
+            if match:
+                pattern_index = int(match.lastgroup[1:])
+                mapping[rel] = patterns[pattern_index][1]
+                matched_patterns.add(pattern_index)
+    for pattern_index, (pattern, _) in enumerate(patterns):
+        if pattern_index in matched_patterns or allow_missing or _is_glob(pattern):
+            continue
+        # A file claimed by an earlier pattern, or a directory, still counts as produced.
+        if os.path.lexists(os.path.join(raw_dir, pattern)):
+            continue
+        msg = "[snapshot] expected file {} was not produced".format(pattern)
+        print(msg, file=sys.stderr)
+        sys.exit(msg)
     return mapping
 
 
+def report_unmatched(mode, files, file_map):
+    """Warns about or fails on produced files that no output pattern matched."""
+    if not mode or mode == "ignore":
+        return
+    unmatched = [rel for rel in files if rel not in file_map]
+    if not unmatched:
+        return
+    lines = ["[snapshot] {} produced files match no output pattern:".format(len(unmatched))]
+    lines.extend("  {}".format(rel) for rel in unmatched[:_MAX_UNMATCHED_LISTED])
+    if len(unmatched) > _MAX_UNMATCHED_LISTED:
+        lines.append("  ... and {} more".format(len(unmatched) - _MAX_UNMATCHED_LISTED))
+    message = "\n".join(lines)
+    if mode == "error":
+        print(message, file=sys.stderr)
+        sys.exit("[snapshot] unmatched outputs are not allowed (unmatched_outputs = \"error\")")
+    print(message, file=sys.stderr)
+
+
 def rlocation(r, path):
     location = r.Rlocation(path)
     assert location, "missing runfile {}".format(path)
     return location
 
 
+@functools.lru_cache(maxsize=None)
+def _tool_path(runfiles_ctx, executable):
+    return rlocation(runfiles_ctx, executable)
+
+
 def run_normalizers(
     runfiles_ctx,
     raw_path,
@@ -154,24 +959,38 @@ def run_normalizers(
     rel_path,
     display_name,
     results_dir,
+    keep_raw=True,
 ):
     if not tools:
-        shutil.copy2(raw_path, normalized_path)
+        # Passthrough: the raw file is the normalized output, so avoid copying
+        # its bytes. A raw file that is not kept can simply be moved.
+        if keep_raw:
+            fileops.link_or_copy(raw_path, normalized_path)
+        else:
+            fileops.move_file(raw_path, normalized_path)
         return True, None
     current_in = raw_path
-    for index, tool in enumerate(tools):
-        tool_path = rlocation(runfiles_ctx, tool["executable"])
-        if index == len(tools) - 1:
+    for group in _fused_groups(tools):
+        last_index = group[-1][0]
+        if last_index == len(tools) - 1:
             current_out = normalized_path
         else:
-            current_out = normalized_path + ".stage{}".format(index)
+            current_out = normalized_path + ".stage{}".format(last_index)
         parent = os.path.dirname(current_out)
         if parent:
             os.makedirs(parent, exist_ok=True)
-        mapping = {"{INPUT}": current_in, "{OUTPUT}": current_out}
-        cmd = [tool_path] + _apply_substitutions(tool["args"], mapping)
-        env = _apply_env(tool["env"], mapping)
-        result = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        name = " | ".join(tool["label"] for _, tool in group)
+        with _PROFILE.span("normalize", name, rel_path) as span:
+            span.bytes_in = os.path.getsize(current_in)
+            if len(group) == 1:
+                tool = group[0][1]
+                mapping = {"{INPUT}": current_in, "{OUTPUT}": current_out}
+                stdout_path = current_out if tool.get("stdout") else None
+                result = run_tool(runfiles_ctx, tool, mapping, stdout_path=stdout_path)
+            else:
+                result = run_pipeline(runfiles_ctx, [tool for _, tool in group], current_in, current_out)
+            if result.returncode == 0:
+                span.bytes_out = os.path.getsize(current_out)
         if result.returncode != 0:
             _write_failure_log(results_dir, rel_path, result.stdout, result.stderr)
             return False, {
@@ -181,9 +1000,6 @@ def run_normalizers(
                 "stderr": result.stderr,
                 "failure_kind": "normalize",
             }
-        if tool.get("stdout"):
-            with open(current_out, "wb") as handle:
-                handle.write(result.stdout)
         if current_in not in (raw_path, normalized_path):
             if os.path.exists(current_in):
                 os.remove(current_in)
@@ -191,6 +1007,128 @@ def run_normalizers(
     return True, None
 
 
+def _fused_groups(tools):
+    """Splits a normalizer chain into runs of stages that can be connected by pipes."""
+    groups = []
+    for index, tool in enumerate(tools):
+        if groups and _can_fuse(groups[-1][-1][1]) and _can_fuse(tool):
+            groups[-1].append((index, tool))
+        else:
+            groups.append([(index, tool)])
+    return groups
+
+
+def _can_fuse(tool):
+    return (
+        _PIPES_SUPPORTED
+        and tool.get("streaming")
+        and not tool.get("worker")
+        and tool.get("builtin") not in _BUILTIN_TOOLS
+    )
+
+
+def run_pipeline(runfiles_ctx, tools, input_path, output_path):
+    """Runs streaming normalizers concurrently, connecting each stage to the next with a pipe.
+
+    Intermediate stages read and write `/dev/fd/N` paths, so only `output_path`
+    touches the disk. Returns the CompletedProcess of the stage that failed, or
+    of the last stage.
+    """
+    processes = []
+    read_fd = None
+    output_handle = None
+    try:
+        for position, tool in enumerate(tools):
+            last = position == len(tools) - 1
+            pass_fds = []
+            if read_fd is None:
+                current_in = input_path
+            else:
+                current_in = "/dev/fd/{}".format(read_fd)
+                pass_fds.append(read_fd)
+            if last:
+                next_read_fd = None
+                current_out = output_path
+                stdout = None
+                if tool.get("stdout"):
+                    output_handle = open(output_path, "wb")
+                    stdout = output_handle
+            else:
+                next_read_fd, write_fd = os.pipe()
+                current_out = "/dev/fd/{}".format(write_fd)
+                if tool.get("stdout"):
+                    stdout = write_fd
+                else:
+                    stdout = None
+                    pass_fds.append(write_fd)
+            mapping = {"{INPUT}": current_in, "{OUTPUT}": current_out}
+            cmd = [_tool_path(runfiles_ctx, tool["executable"])] + _apply_substitutions(tool["args"], mapping)
+            stdout_capture = None
+            if stdout is None:
+                stdout_capture = tempfile.TemporaryFile()
+                stdout = stdout_capture
+            stderr_capture = tempfile.TemporaryFile()
+            try:
+                process = subprocess.Popen(
+                    cmd,
+                    env=_apply_env(tool["env"], mapping),
+                    stdout=stdout,
+                    stderr=stderr_capture,
+                    pass_fds=pass_fds,
+                )
+            finally:
+                # The child owns its pipe ends now; closing ours lets EOF and
+                # EPIPE propagate when a neighbouring stage exits.
+                if read_fd is not None:
+                    os.close(read_fd)
+                if not last:
+                    os.close(write_fd)
+                read_fd = next_read_fd
+            processes.append((process, cmd, stdout_capture, stderr_capture))
+        if output_handle:
+            output_handle.close()
+            output_handle = None
+        results = []
+        for process, cmd, stdout_capture, stderr_capture in processes:
+            returncode = _wait_process(process)
+            results.append(
+                subprocess.CompletedProcess(
+                    cmd,
+                    returncode,
+                    _read_capture(stdout_capture),
+                    _read_capture(stderr_capture),
+                )
+            )
+    finally:
+        if read_fd is not None:
+            os.close(read_fd)
+        if output_handle:
+            output_handle.close()
+        for process, _, stdout_capture, stderr_capture in processes:
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+            if stdout_capture:
+                stdout_capture.close()
+            stderr_capture.close()
+    failed = [result for result in results if result.returncode != 0]
+    # A stage killed by SIGPIPE usually just lost its reader; report the cause.
+    # Shell wrappers report the signal as 128 + SIGPIPE.
+    for result in failed:
+        if result.returncode not in (-signal.SIGPIPE, 128 + signal.SIGPIPE):
+            return result
+    if failed:
+        return failed[0]
+    return results[-1]
+
+
+def _read_capture(handle):
+    if handle is None:
+        return b""
+    handle.seek(0)
+    return handle.read()
+
+
 def run_comparator(
     runfiles_ctx,
     format_cfg,
@@ -199,16 +1137,31 @@ def run_comparator(
     rel_path,
     display_name,
     results_dir,
+    snapshot_compressed=False,
 ):
-    comparator_spec = format_cfg["compare"]
-    comparator_path = rlocation(runfiles_ctx, comparator_spec["executable"])
     mapping = {
         "{OUTPUT}": _safe_relpath(normalized_path),
         "{SNAPSHOT}": _safe_relpath(snapshot_path),
     }
-    cmd = [comparator_path] + _apply_substitutions(comparator_spec["args"], mapping)
-    env = _apply_env(comparator_spec["env"], mapping)
-    result = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    tool = format_cfg["compare"]
+    decompressed_path = None
+    if snapshot_compressed and os.path.exists(snapshot_path):
+        if tool.get("builtin") in _BUILTIN_TOOLS:
+            # Built-in comparators decompress while reading.
+            tool = dict(tool, args=list(tool["args"]) + ["--decompress", "{SNAPSHOT}"])
+        else:
+            decompressed_path = _decompress_snapshot(snapshot_path, rel_path)
+            mapping["{SNAPSHOT}"] = _safe_relpath(decompressed_path)
+    try:
+        with _PROFILE.span("compare", tool["label"], rel_path) as span:
+            span.bytes_in = os.path.getsize(normalized_path)
+            if os.path.exists(snapshot_path):
+                span.bytes_in += os.path.getsize(snapshot_path)
+            result = run_tool(runfiles_ctx, tool, mapping)
+            span.bytes_out = len(result.stdout or b"") + len(result.stderr or b"")
+    finally:
+        if decompressed_path:
+            os.remove(decompressed_path)
     if result.returncode != 0:
         _write_failure_log(results_dir, rel_path, result.stdout, result.stderr)
         return False, {
@@ -221,7 +1174,446 @@ def run_comparator(
     return True, None
 
 
-def resolve_snapshot_path(r, config, rel_path):
+class PendingComparison:
+    """A normalized output whose comparison is left to one call of a batch comparator."""
+
+    def __init__(self, rel_path, display_name, tool, normalized_path, snapshot_path, snapshot_compressed):
+        self.rel_path = rel_path
+        self.display_name = display_name
+        self.tool = tool
+        self.normalized_path = normalized_path
+        self.snapshot_path = snapshot_path
+        self.snapshot_compressed = snapshot_compressed
+        self.cache_key = None
+
+
+def run_batch_comparisons(runfiles_ctx, pending, results_dir, result_cache=None):
+    """Runs each batch comparator once for its pending files; returns {rel_path: failure or None}."""
+    groups = {}
+    for item in pending:
+        groups.setdefault(json.dumps(item.tool, sort_keys=True), []).append(item)
+    failures = {}
+    for items in groups.values():
+        failures.update(run_batch_comparator(runfiles_ctx, items[0].tool, items, results_dir))
+    if result_cache:
+        for item in pending:
+            if failures[item.rel_path] is None and item.cache_key:
+                _cache_store(result_cache, item.cache_key, item.normalized_path)
+    return failures
+
+
+def run_batch_comparator(runfiles_ctx, tool, pending, results_dir):
+    """Compares `pending` with a single call of `tool`, following the protocol on snapshot_comparator."""
+    handle, manifest_path = tempfile.mkstemp(
+        prefix="snapshot_batch_",
+        suffix=".jsonl",
+        dir=os.environ.get("TEST_TMPDIR"),
+    )
+    temporary = [manifest_path]
+    try:
+        bytes_in = 0
+        with os.fdopen(handle, "w", encoding="utf-8") as manifest:
+            for item in pending:
+                snapshot_path = item.snapshot_path
+                if os.path.exists(snapshot_path):
+                    bytes_in += os.path.getsize(snapshot_path)
+                    if item.snapshot_compressed:
+                        snapshot_path = _decompress_snapshot(snapshot_path, item.rel_path)
+                        temporary.append(snapshot_path)
+                bytes_in += os.path.getsize(item.normalized_path)
+                entry = {
+                    "rel_path": item.rel_path.replace(os.sep, "/"),
+                    "output": _safe_relpath(item.normalized_path),
+                    "snapshot": _safe_relpath(snapshot_path),
+                }
+                manifest.write(json.dumps(entry) + "\n")
+        with _PROFILE.span("compare", tool["label"]) as span:
+            span.bytes_in = bytes_in
+            result = run_tool(runfiles_ctx, tool, {"{MANIFEST}": _safe_relpath(manifest_path)})
+            span.bytes_out = len(result.stdout or b"") + len(result.stderr or b"")
+    finally:
+        for path in temporary:
+            os.remove(path)
+
+    reported = _parse_batch_results(result.stdout)
+    failures = {}
+    for item in pending:
+        response = reported.get(item.rel_path.replace(os.sep, "/"))
+        if response is not None and response.get("exit_code") == 0:
+            failures[item.rel_path] = None
+            continue
+        if response is None:
+            message = "[snapshot] batch comparator {} exited with {} and reported no result for {}\n".format(
+                tool["label"],
+                result.returncode,
+                item.rel_path,
+            )
+            stdout = b""
+            stderr = message.encode("utf-8") + (result.stderr or b"")
+        else:
+            stdout = (response.get("stdout") or "").encode("utf-8")
+            stderr = (response.get("stderr") or "").encode("utf-8")
+        _write_failure_log(results_dir, item.rel_path, stdout, stderr)
+        failures[item.rel_path] = {
+            "rel_path": item.rel_path,
+            "display_name": item.display_name,
+            "stdout": stdout,
+            "stderr": stderr,
+            "failure_kind": "compare",
+        }
+    return failures
+
+
+def _parse_batch_results(stdout):
+    reported = {}
+    for line in (stdout or b"").splitlines():
+        try:
+            response = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(response, dict) and "rel_path" in response:
+            reported[response["rel_path"]] = response
+    return reported
+
+
+def _decompress_snapshot(snapshot_path, rel_path):
+    """Writes the decompressed snapshot to a temporary file for comparators that cannot read it compressed."""
+    handle, path = tempfile.mkstemp(
+        prefix="snapshot_",
+        suffix="_" + os.path.basename(rel_path),
+        dir=os.environ.get("TEST_TMPDIR"),
+    )
+    with os.fdopen(handle, "wb") as output:
+        compressed.decompress_to(snapshot_path, output)
+    return path
+
+
+def run_tool(runfiles_ctx, tool, mapping, stdout_path=None):
+    """Run a normalizer or comparator spec and return a CompletedProcess.
+
+    If `stdout_path` is set, the tool's stdout is written to that file instead
+    of being returned.
+    """
+    args = _apply_substitutions(tool["args"], mapping)
+    builtin = tool.get("builtin")
+    if builtin in _BUILTIN_TOOLS:
+        result = _BUILTIN_PROCESSES.run(builtin, args)
+    elif tool.get("worker"):
+        tool_path = _tool_path(runfiles_ctx, tool["executable"])
+        result = _WORKERS.run(tool_path, tool, args, mapping)
+    else:
+        cmd = [_tool_path(runfiles_ctx, tool["executable"])] + args
+        env = _apply_env(tool["env"], mapping)
+        if not stdout_path:
+            return _run_process(cmd, env)
+        with open(stdout_path, "wb") as handle:
+            return _run_process(cmd, env, stdout=handle)
+    if stdout_path and result.returncode == 0:
+        with open(stdout_path, "wb") as handle:
+            handle.write(result.stdout)
+        result.stdout = b""
+    return result
+
+
+def _run_process(cmd, env, stdout=None):
+    """Runs `cmd` like subprocess.run with captured output, profiling the child.
+
+    Output goes to temporary files rather than pipes so the child can be
+    reaped with wait4, which reports its resource usage.
+    """
+    stdout_capture = None
+    if stdout is None:
+        stdout_capture = tempfile.TemporaryFile()
+        stdout = stdout_capture
+    try:
+        with tempfile.TemporaryFile() as stderr_capture:
+            if _POSIX_SPAWN:
+                returncode = _spawn_and_wait(cmd, env, stdout.fileno(), stderr_capture.fileno())
+            else:
+                process = subprocess.Popen(cmd, env=env, stdout=stdout, stderr=stderr_capture)
+                try:
+                    returncode = _wait_process(process)
+                finally:
+                    if process.returncode is None:
+                        process.kill()
+                        process.wait()
+            return subprocess.CompletedProcess(
+                cmd,
+                returncode,
+                _read_capture(stdout_capture),
+                _read_capture(stderr_capture),
+            )
+    finally:
+        if stdout_capture:
+            stdout_capture.close()
+
+
+def _spawn_and_wait(cmd, env, stdout_fd, stderr_fd):
+    pid = os.posix_spawn(
+        cmd[0],
+        cmd,
+        env,
+        file_actions=[
+            (os.POSIX_SPAWN_DUP2, stdout_fd, 1),
+            (os.POSIX_SPAWN_DUP2, stderr_fd, 2),
+        ],
+        setsigdef=_RESTORED_SIGNALS,
+    )
+    try:
+        return _wait_pid(pid)
+    except BaseException:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+
+
+def _wait_process(process):
+    """Waits for `process` and attributes its CPU time and peak RSS to the current span."""
+    if not hasattr(os, "wait4"):
+        return process.wait()
+    try:
+        process.returncode = _wait_pid(process.pid)
+    except ChildProcessError:
+        return process.wait()
+    return process.returncode
+
+
+def _wait_pid(pid):
+    _, status, usage = os.wait4(pid, 0)
+    _PROFILE.add_child_usage(usage)
+    return os.waitstatus_to_exitcode(status)
+
+
+def _run_builtin(name, args):
+    """Calls a built-in tool; returns (returncode, stdout, stderr, cpu_seconds).
+
+    Runs in the calling thread or in a BuiltinProcessPool worker, so it
+    returns plain values that can be sent back from another process.
+    """
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    cpu_start = time.thread_time()
+    try:
+        returncode = _BUILTIN_TOOLS[name](args, stdout, stderr)
+    except SystemExit as exc:
+        # argparse reports usage errors by exiting.
+        returncode = exc.code if isinstance(exc.code, int) else 1
+    except Exception as exc:  # pylint: disable=broad-except
+        print("{}: {}".format(type(exc).__name__, exc), file=stderr)
+        returncode = 1
+    return (
+        returncode,
+        stdout.getvalue().encode("utf-8"),
+        stderr.getvalue().encode("utf-8"),
+        time.thread_time() - cpu_start,
+    )
+
+
+# Forking the runner, which already runs threads, could copy locks they hold.
+# A fork server is a fresh interpreter that imports the runner once and then
+# forks each worker cheaply; where there is none, workers start from scratch.
+_BUILTIN_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Time spent in built-in tools before a pool is worth starting; starting one
+# takes a few hundred milliseconds.
+_BUILTIN_POOL_AFTER_SECONDS = 0.5
+
+
+class BuiltinProcessPool:
+    """Runs built-in tools in worker processes once calls from several threads overlap.
+
+    The built-in tools are pure Python, so on runner threads they would take
+    turns holding the GIL. The pool is started in the background once calls
+    overlap after _BUILTIN_POOL_AFTER_SECONDS of work, and calls run in the
+    calling thread until its workers are up. Tests with little work for the
+    built-in tools, or with a single job or CPU, start no process at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._running = 0
+        self._busy_seconds = 0.0
+        self._launcher = None
+        self._executor = None
+        self._ready = False
+
+    def start(self, jobs):
+        """Allows up to `jobs` worker processes, but no more than there are CPUs."""
+        with self._lock:
+            self._workers = min(jobs, available_cpus())
+
+    def run(self, name, args):
+        with self._lock:
+            executor = self._executor if self._ready else None
+            if executor is None:
+                if (
+                    self._running
+                    and self._workers > 1
+                    and self._launcher is None
+                    and self._busy_seconds >= _BUILTIN_POOL_AFTER_SECONDS
+                ):
+                    self._launcher = threading.Thread(target=self._launch, args=(self._workers,), daemon=True)
+                    self._launcher.start()
+                self._running += 1
+        if executor is None:
+            start = time.perf_counter()
+            try:
+                returncode, stdout, stderr, _ = _run_builtin(name, args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._busy_seconds += time.perf_counter() - start
+            return subprocess.CompletedProcess(args, returncode, stdout, stderr)
+        try:
+            returncode, stdout, stderr, cpu = executor.submit(_run_builtin, name, args).result()
+        except concurrent.futures.process.BrokenProcessPool as exc:
+            message = "[snapshot] built-in {} worker process died: {}\n".format(name, exc)
+            return subprocess.CompletedProcess(args, 1, b"", message.encode("utf-8"))
+        # The calling thread only waited; the worker did the work.
+        _PROFILE.add_cpu(cpu)
+        return subprocess.CompletedProcess(args, returncode, stdout, stderr)
+
+    def _launch(self, workers):
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(_BUILTIN_START_METHOD),
+        )
+        with self._lock:
+            self._executor = executor
+        # One trivial task per worker makes the pool start all of them now.
+        concurrent.futures.wait([executor.submit(int) for _ in range(workers)])
+        with self._lock:
+            self._ready = True
+
+    def shutdown(self):
+        with self._lock:
+            launcher = self._launcher
+            self._launcher = None
+        if launcher is not None:
+            launcher.join()
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+            self._ready = False
+            self._busy_seconds = 0.0
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+class WorkerPool:
+    """Persistent worker processes shared by the runner threads.
+
+    Workers are started lazily, one per concurrently running request, and speak
+    the JSON-lines protocol documented on snapshot_normalizer.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._processes = []
+
+    def run(self, tool_path, tool, args, mapping):
+        request = {"args": args, "env": _apply_substitutions_dict(tool["env"], mapping)}
+        for token, value in mapping.items():
+            request[token.strip("{}").lower()] = value
+        process = self._acquire(tool_path, tool)
+        try:
+            process.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+            process.stdin.flush()
+            line = process.stdout.readline()
+            response = json.loads(line) if line else None
+        except (OSError, ValueError):
+            response = None
+        if not isinstance(response, dict):
+            return self._discard(process, args, "[snapshot] persistent worker {} stopped responding".format(tool_path))
+        try:
+            exit_code = int(response.get("exit_code", 1))
+        except (TypeError, ValueError):
+            return self._discard(
+                process,
+                args,
+                "[snapshot] persistent worker {} replied with an invalid exit_code: {!r}".format(
+                    tool_path,
+                    response.get("exit_code"),
+                ),
+            )
+        self._release(tool_path, process)
+        return subprocess.CompletedProcess(
+            args,
+            exit_code,
+            (response.get("stdout") or "").encode("utf-8"),
+            (response.get("stderr") or "").encode("utf-8"),
+        )
+
+    def shutdown(self):
+        with self._lock:
+            processes = self._processes
+            self._processes = []
+            self._idle = {}
+        for process in processes:
+            if process.stdin:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def _acquire(self, tool_path, tool):
+        with self._lock:
+            idle = self._idle.get(tool_path)
+            if idle:
+                return idle.pop()
+        process = subprocess.Popen(
+            [tool_path, "--persistent_worker"],
+            env=_apply_env({}, {}),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        with self._lock:
+            self._processes.append(process)
+        return process
+
+    def _release(self, tool_path, process):
+        with self._lock:
+            self._idle.setdefault(tool_path, []).append(process)
+
+    def _discard(self, process, args, message):
+        """Fails the request with `message`; the next request for the tool starts a fresh worker."""
+        process.kill()
+        return subprocess.CompletedProcess(args, 1, b"", message.encode("utf-8"))
+
+
+_WORKERS = WorkerPool()
+_BUILTIN_PROCESSES = BuiltinProcessPool()
+
+
+def resolve_snapshot_entry(snapshot_digests, rel_path):
+    """Returns (stored_rel, digest) for the snapshot of the output at `rel_path`.
+
+    A snapshot may be stored compressed as `<rel_path>.gz` or `<rel_path>.zst`;
+    its digest then describes the decompressed content.
+    """
+    rel = rel_path.replace(os.sep, "/")
+    if rel in snapshot_digests:
+        return rel, snapshot_digests[rel]
+    for suffix in compressed.SUFFIXES:
+        entry = snapshot_digests.get(rel + suffix)
+        if entry is not None:
+            return rel + suffix, entry.get("content")
+    return rel, None
+
+
+def resolve_snapshot_path(r, config, rel_path, digest=None):
+    """Returns the snapshot file of `rel_path`, a blob of the snapshot store if the test uses one."""
+    store_prefix = config.get("snapshot_store_prefix")
+    if store_prefix and digest:
+        return rlocation(r, store_prefix.rstrip("/") + "/" + digests.blob_path(digest["sha256"]))
     rel = rel_path.replace(os.sep, "/")
     prefix = config["snapshot_prefix"].rstrip("/")
     if prefix:
@@ -235,26 +1627,42 @@ def _is_glob(pattern):
     return any(char in pattern for char in ["*", "?", "["])
 
 
+@functools.lru_cache(maxsize=None)
+def _template(value):
+    """Splits `value` once into literal text at even and {TOKEN}s at odd positions."""
+    return tuple(_TOKEN.split(value))
+
+
+def _expand(value, mapping):
+    parts = _template(value)
+    if len(parts) == 1:
+        return value
+    return "".join(mapping.get(part, part) if index % 2 else part for index, part in enumerate(parts))
+
+
 def _apply_substitutions(values, mapping):
-    result = []
-    for value in values:
-        expanded = value
-        for key, replacement in mapping.items():
-            expanded = expanded.replace(key, replacement)
-        result.append(expanded)
-    return result
+    return [_expand(value, mapping) for value in values]
+
+
+def _apply_substitutions_dict(values, mapping):
+    return dict(zip(values.keys(), _apply_substitutions(values.values(), mapping)))
 
 
 def _apply_env(env, mapping):
-    result = os.environ.copy()
+    """Returns the environment for a tool; the result must not be modified."""
+    if not env:
+        return _base_env()
+    result = _base_env().copy()
     for key, value in env.items():
-        expanded = value
-        for token, replacement in mapping.items():
-            expanded = expanded.replace(token, replacement)
-        result[key] = expanded
+        result[key] = _expand(value, mapping)
     return result
 
 
+@functools.lru_cache(maxsize=1)
+def _base_env():
+    return os.environ.copy()
+
+
 def _safe_relpath(path, start=None):
     """Return a relpath, falling back to abs path for Windows cross-drive paths."""
     try:
@@ -289,13 +1697,15 @@ def _print_failure(failure):
     print("-" * 80)
 
 
-def print_failure_summary(failures, total):
+def print_failure_summary(failures, total, skipped=0):
     if failures:
         print("Failed snapshots:")
         for failure in failures:
             print("- {} ({})".format(failure["display_name"], failure["rel_path"]))
     failed = len(failures)
     summary = "[{}/{}] snapshot files".format(failed, total)
+    if skipped:
+        summary += " ({} skipped after reaching the failure limit)".format(skipped)
     print(summary)
 
 
@@ -323,53 +1733,169 @@ def _truncate_output(output):
     return "\n".join(head + ["..."] + tail)
 
 
-def _build_result(rel_path, display_name, failure):
+def _build_result(rel_path, display_name, failure, elapsed=None, skipped=False):
     result = {
         "rel_path": rel_path,
         "display_name": display_name,
-        "status": "pass",
+        "status": "skipped" if skipped else "pass",
+        "time": elapsed,
     }
     if failure:
         result["status"] = "fail"
-        result["stdout"] = failure.get("stdout")
-        result["stderr"] = failure.get("stderr")
         result["failure_kind"] = failure.get("failure_kind") or "failed"
     return result
 
 
-def write_junit_report(config, results):
+def write_output_manifest(base_dir, results, shard, compression=None, store=None):
+    """Records which files this run normalized, so the updater can prune stale snapshots.
+
+    The run is complete when every file has a normalized output, i.e. no
+    normalizer failed and none was skipped. `compression` and `store` tell
+    the updater how and where to store snapshots.
+    """
+    manifest = {
+        "outputs": [
+            result["rel_path"].replace(os.sep, "/") for result in results if result["status"] != "skipped"
+        ],
+        "complete": all(
+            result["status"] != "skipped" and result.get("failure_kind") in (None, "compare") for result in results
+        ),
+        "shard": list(shard) if shard else None,
+        "compression": compression,
+        "store": store,
+    }
+    with open(os.path.join(base_dir, "snapshot_outputs.json"), "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2)
+        handle.write("\n")
+
+
+def write_profile(base_dir):
+    """Writes profile.json, and a Chrome trace when SNAPSHOT_TRACE is set."""
+    _PROFILE.write(os.path.join(base_dir, "profile.json"))
+    if _env_flag("SNAPSHOT_TRACE"):
+        _PROFILE.write_trace(os.path.join(base_dir, "profile.trace.json"))
+
+
+def open_junit_report(config):
+    """Returns a JUnitWriter for XML_OUTPUT_FILE, or None when Bazel did not ask for a report."""
     output_path = os.environ.get("XML_OUTPUT_FILE")
     if not output_path:
-        return
+        return None
     suite_name = os.environ.get("TEST_TARGET", "").strip() or config.get("test_name") or "snapshot"
-    suite = ET.Element(
-        "testsuite",
-        name=suite_name,
-        tests=str(len(results)),
-        failures=str(sum(1 for r in results if r["status"] == "fail")),
+    return JUnitWriter(
+        output_path,
+        suite_name,
+        _env_bytes("SNAPSHOT_JUNIT_MAX_FAILURE_BYTES", _DEFAULT_JUNIT_MAX_FAILURE_BYTES),
+        _env_bytes("SNAPSHOT_JUNIT_MAX_BYTES", _DEFAULT_JUNIT_MAX_BYTES),
     )
-    for result in results:
-        testcase = ET.SubElement(
-            suite,
-            "testcase",
-            classname=result["display_name"],
-            name=result["rel_path"],
+
+
+def _env_bytes(name, default):
+    value = os.environ.get(name) or default
+    try:
+        return int(value)
+    except ValueError:
+        sys.exit("[snapshot] {} must be an integer, got {!r}".format(name, value))
+
+
+class JUnitWriter:
+    """Writes the JUnit report one testcase at a time.
+
+    Testcases are spooled to a temporary file as results arrive, so no
+    failure output is held until the end; close() writes the <testsuite>
+    element, whose counts are only known then, around them. Failure output
+    is cut at `max_failure_bytes` per failure and `max_bytes` in total (0
+    for no limit) and points at the full log under results/.
+    """
+
+    def __init__(self, output_path, suite_name, max_failure_bytes, max_bytes):
+        self._output_path = output_path
+        self._suite_name = suite_name
+        self._max_failure_bytes = max_failure_bytes
+        self._remaining = max_bytes or None
+        self._body = tempfile.TemporaryFile()
+        self._tests = 0
+        self._failures = 0
+        self._skipped = 0
+
+    def add(self, result, failure):
+        self._tests += 1
+        attrs = {"classname": result["display_name"], "name": result["rel_path"]}
+        if result.get("time") is not None:
+            attrs["time"] = "{:.3f}".format(result["time"])
+        if result["status"] == "skipped":
+            self._skipped += 1
+            self._write(
+                "<testcase{}><skipped{}/></testcase>\n".format(
+                    _xml_attrs(attrs),
+                    _xml_attrs({"message": "not checked: failure limit reached"}),
+                )
+            )
+            return
+        if result["status"] != "fail":
+            self._write("<testcase{}/>\n".format(_xml_attrs(attrs)))
+            return
+        self._failures += 1
+        message = "{} failed".format(result.get("failure_kind", "test"))
+        text = self._bounded_output(result["rel_path"], failure)
+        self._write(
+            "<testcase{}><failure{}>{}</failure></testcase>\n".format(
+                _xml_attrs(attrs),
+                _xml_attrs({"message": message}),
+                saxutils.escape(_XML_INVALID.sub("\ufffd", text)),
+            )
         )
-        if result["status"] == "fail":
-            message = "{} failed".format(result.get("failure_kind", "test"))
-            failure = ET.SubElement(testcase, "failure", message=message)
-            output_text = _combine_output(result.get("stdout"), result.get("stderr"))
-            failure.text = output_text
-    tree = ET.ElementTree(suite)
-    parent = os.path.dirname(output_path)
-    if parent:
-        os.makedirs(parent, exist_ok=True)
-    tree.write(output_path, encoding="utf-8", xml_declaration=True)
 
+    def _bounded_output(self, rel_path, failure):
+        output = _combine_output(failure.get("stdout"), failure.get("stderr"))
+        limit = self._max_failure_bytes or None
+        if self._remaining is not None:
+            limit = self._remaining if limit is None else min(limit, self._remaining)
+        encoded = output.encode("utf-8")
+        log_path = "results/{}.log".format(rel_path.replace(os.sep, "/"))
+        if limit is not None and len(encoded) > limit:
+            if limit <= 0:
+                output = "[output omitted: report size limit reached; full output in {}]".format(log_path)
+            else:
+                output = encoded[:limit].decode("utf-8", errors="ignore")
+                output += "\n[output truncated after {} of {} bytes; full output in {}]".format(
+                    limit,
+                    len(encoded),
+                    log_path,
+                )
+            encoded = encoded[:max(limit, 0)]
+        if self._remaining is not None:
+            self._remaining -= len(encoded)
+        return output
 
+    def _write(self, text):
+        self._body.write(text.encode("utf-8"))
 
+    def close(self):
+        parent = os.path.dirname(self._output_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        suite = {
+            "name": self._suite_name,
+            "tests": str(self._tests),
+            "failures": str(self._failures),
+            "skipped": str(self._skipped),
+        }
+        with open(self._output_path, "wb") as handle:
+            handle.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+            handle.write("<testsuite{}>\n".format(_xml_attrs(suite)).encode("utf-8"))
+            self._body.seek(0)
+            shutil.copyfileobj(self._body, handle)
+            handle.write(b"</testsuite>\n")
+        self._body.close()
 
 
+def _xml_attrs(attrs):
+    return "".join(
+        " {}={}".format(key, saxutils.quoteattr(_XML_INVALID.sub("\ufffd", value)))
+        for key, value in attrs.items()
+    )
+
 
 if __name__ == "__main__":
     main()
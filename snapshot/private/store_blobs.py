@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Copies the snapshot store blobs a test's manifest refers to into a directory of their own."""
+
+import argparse
+import json
+import os
+import sys
+
+from snapshot.private import digests
+from snapshot.private import fileops
+
+
+def select_blobs(manifest, blobs, output_dir):
+    """Copies the blobs named in `manifest` from `blobs`, {sha256: path}, to `output_dir`.
+
+    Blobs missing from the store are left out; the test then reports their
+    snapshots as missing.
+    """
+    for sha256 in sorted({digest["sha256"] for digest in manifest.values()}):
+        src = blobs.get(sha256)
+        if src is None:
+            continue
+        dst = os.path.join(output_dir, digests.blob_path(sha256))
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        fileops.copy_file(src, dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy the snapshot store blobs a manifest refers to.",
+        fromfile_prefix_chars="@",
+    )
+    parser.add_argument("manifest", help="Path of the test's store manifest.")
+    parser.add_argument("output_dir", help="Directory to copy the blobs to.")
+    parser.add_argument("blobs", nargs="*", help="Paths of the blobs in the store.")
+    args = parser.parse_args()
+
+    with open(args.manifest, "r", encoding="utf-8") as handle:
+        manifest = json.load(handle)
+    os.makedirs(args.output_dir, exist_ok=True)
+    select_blobs(manifest, {os.path.basename(path): path for path in args.blobs}, args.output_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
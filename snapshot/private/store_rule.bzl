@@ -0,0 +1,52 @@
+SnapshotStoreInfo = provider(
+    doc = "A content-addressed directory of snapshot blobs shared by several snapshot tests.",
+    fields = {
+        "root": "Directory of the store, relative to the workspace root.",
+        "blobs": "Depset of the blob files in the store.",
+    },
+)
+
+def _snapshot_store_impl(ctx):
+    root_parts = [part for part in [ctx.label.workspace_root, ctx.label.package, ctx.attr.directory] if part]
+    blobs = depset(ctx.files.blobs)
+    return [
+        DefaultInfo(files = blobs),
+        SnapshotStoreInfo(
+            root = "/".join(root_parts),
+            blobs = blobs,
+        ),
+    ]
+
+_snapshot_store = rule(
+    implementation = _snapshot_store_impl,
+    attrs = {
+        "blobs": attr.label_list(allow_files = True),
+        "directory": attr.string(mandatory = True),
+    },
+)
+
+def snapshot_store(name, visibility = None):
+    """Create a content-addressed store that snapshot tests can share.
+
+    Snapshot tests with `snapshot_store` set to this target keep only a
+    manifest, `snapshots/<test name>.json`, mapping each output path to the
+    size and SHA-256 of its snapshot. The snapshot contents live in the
+    store, in the directory `name` next to this BUILD file, as
+    `<sha256[:2]>/<sha256>`, so identical snapshots of different tests are
+    stored once. The updater writes blobs that are missing and never
+    removes any, since other tests may still use them.
+
+    Each test using the store gets only the blobs its manifest lists in its
+    runfiles, copied there by an action that reads the manifest.
+
+    Args:
+      name: Target name, and the directory the blobs are stored in.
+      visibility: Visibility of the store, which must include the
+        packages of the tests using it.
+    """
+    _snapshot_store(
+        name = name,
+        blobs = native.glob([name + "/**"], allow_empty = True),
+        directory = name,
+        visibility = visibility,
+    )
@@ -1,6 +1,7 @@
-load("//snapshot/private:update_rule.bzl", "snapshot_update_rule")
-load("//snapshot/private:command_tool.bzl", "SnapshotCommandInfo")
+load("//snapshot/private:update_rule.bzl", "SnapshotTestInfo", "snapshot_update_rule")
+load("//snapshot/private:command_tool.bzl", "SnapshotCommandInfo", "builtin_tool")
 load("//snapshot/private:runfiles.bzl", "executable_runfile_path")
+load("//snapshot/private:store_rule.bzl", "SnapshotStoreInfo")
 
 def _rlocation(ctx, target):
     return executable_runfile_path(ctx, target)
@@ -45,32 +46,48 @@ def _normalizer_spec(ctx, target):
     if SnapshotCommandInfo in target:
         info = target[SnapshotCommandInfo]
         return {
+            "label": str(target.label),
             "executable": info.executable,
             "args": info.args,
             "env": info.env,
             "stdout": info.stdout,
+            "streaming": info.streaming,
+            "builtin": info.builtin,
+            "worker": info.worker,
         }
     return {
+        "label": str(target.label),
         "executable": _rlocation(ctx, target),
         "args": ["{INPUT}", "{OUTPUT}"],
         "env": {},
         "stdout": False,
+        "streaming": False,
+        "builtin": builtin_tool(target),
+        "worker": False,
     }
 
 def _comparator_spec(ctx, target):
     if SnapshotCommandInfo in target:
         info = target[SnapshotCommandInfo]
         return {
+            "label": str(target.label),
             "executable": info.executable,
             "args": info.args,
             "env": info.env,
             "stdout": False,
+            "builtin": info.builtin,
+            "worker": info.worker,
+            "batch": info.batch,
         }
     return {
+        "label": str(target.label),
         "executable": _rlocation(ctx, target),
         "args": ["{SNAPSHOT}", "{OUTPUT}"],
         "env": {},
         "stdout": False,
+        "builtin": builtin_tool(target),
+        "worker": False,
+        "batch": False,
     }
 
 snapshot_format = rule(
@@ -86,12 +103,74 @@ snapshot_format = rule(
         ),
         "compare": attr.label(
             cfg = "exec",
-            doc = "Executable target or snapshot_comparator rule that compares each test output to its snapshot.",
+            doc = "Executable target or snapshot_comparator rule that compares each test output to its snapshot. Not invoked for outputs that are byte-identical to their snapshot.",
         ),
     },
 )
 
-def _build_config(ctx):
+def _snapshot_digests(ctx):
+    """Declares an action that records the size and SHA-256 of every snapshot file."""
+    manifest = ctx.actions.declare_file(ctx.label.name + "_snapshot_digests.json")
+    snapshot_dir = "snapshots/%s/" % ctx.label.name
+    args = ctx.actions.args()
+    args.add(manifest)
+    for file in ctx.files.snapshots:
+        rel_path = file.owner.name
+        if file.owner.package != ctx.label.package or not rel_path.startswith(snapshot_dir):
+            continue
+        args.add(rel_path.removeprefix(snapshot_dir))
+        args.add(file)
+    args.use_param_file("@%s", use_always = True)
+    args.set_param_file_format("multiline")
+    ctx.actions.run(
+        executable = ctx.executable._digests,
+        arguments = [args],
+        inputs = ctx.files.snapshots,
+        outputs = [manifest],
+        mnemonic = "SnapshotDigests",
+        progress_message = "Hashing snapshots for %{label}",
+    )
+    return manifest
+
+def _store_manifest(ctx):
+    """Returns the manifest mapping outputs to blobs in the snapshot store.
+
+    It has the same format as the digests written by _snapshot_digests, so
+    no hashing action is needed. Before the first update there is none yet.
+    """
+    manifest_name = "snapshots/%s.json" % ctx.label.name
+    for file in ctx.files.snapshots:
+        if file.owner.package == ctx.label.package and file.owner.name == manifest_name:
+            return file
+    manifest = ctx.actions.declare_file(ctx.label.name + "_snapshot_digests.json")
+    ctx.actions.write(manifest, "{}\n")
+    return manifest
+
+def _store_blobs(ctx, manifest):
+    """Declares an action that copies the store blobs listed in `manifest` into a directory.
+
+    Only that directory goes into the runfiles, so a test does not stage the
+    blobs of every other test sharing the store.
+    """
+    blobs_dir = ctx.actions.declare_directory(ctx.label.name + "_snapshot_blobs")
+    store_blobs = ctx.attr.snapshot_store[SnapshotStoreInfo].blobs
+    args = ctx.actions.args()
+    args.add(manifest)
+    args.add(blobs_dir.path)
+    args.add_all(store_blobs)
+    args.use_param_file("@%s", use_always = True)
+    args.set_param_file_format("multiline")
+    ctx.actions.run(
+        executable = ctx.executable._store_blobs,
+        arguments = [args],
+        inputs = depset([manifest], transitive = [store_blobs]),
+        outputs = [blobs_dir],
+        mnemonic = "SnapshotStoreBlobs",
+        progress_message = "Selecting snapshot blobs for %{label}",
+    )
+    return blobs_dir
+
+def _build_config(ctx, digests, blobs_dir = None):
     deps_for_expansion = [ctx.attr.test]
     deps_for_expansion.extend(ctx.attr.data)
 
@@ -127,6 +206,13 @@ def _build_config(ctx):
         snapshot_parts.append(snapshot_package.strip("/"))
     snapshot_parts.append(snapshot_dir.strip("/"))
     snapshot_prefix = "/".join(snapshot_parts)
+    store_root = None
+    store_prefix = None
+    if ctx.attr.snapshot_store:
+        if ctx.attr.compress_snapshots:
+            fail("compress_snapshots cannot be combined with snapshot_store")
+        store_root = ctx.attr.snapshot_store[SnapshotStoreInfo].root
+        store_prefix = "{}/{}".format(ctx.workspace_name, blobs_dir.short_path)
     return {
         "test_runfile": _rlocation(ctx, ctx.attr.test),
         "test_args": _expand_args(ctx, deps_for_expansion),
@@ -136,6 +222,17 @@ def _build_config(ctx):
         "snapshot_rel_root": snapshot_rel_root,
         "test_package": ctx.attr.test.label.package,
         "test_name": ctx.attr.test.label.name,
+        "jobs": ctx.attr.jobs,
+        "shard_outputs": ctx.attr.shard_outputs,
+        "unmatched_outputs": ctx.attr.unmatched_outputs,
+        "keep_raw": ctx.attr.keep_raw,
+        "stream_outputs": ctx.attr.stream_outputs,
+        "fail_fast": ctx.attr.fail_fast,
+        "max_failures": ctx.attr.max_failures,
+        "snapshot_compression": ctx.attr.compress_snapshots,
+        "snapshot_digests": "{}/{}".format(ctx.workspace_name, digests.short_path),
+        "snapshot_store_root": store_root,
+        "snapshot_store_prefix": store_prefix,
     }
 
 def _expand_args(ctx, deps):
@@ -151,13 +248,30 @@ def _expand_env(ctx, deps):
         expanded[key] = ctx.expand_location(value, deps).replace("$$", "$")
     return expanded
 
+def _snapshot_test_info(ctx):
+    package_parts = [part for part in [ctx.label.workspace_root, ctx.label.package] if part]
+    return SnapshotTestInfo(
+        label = ctx.label,
+        testlogs = "/".join(package_parts + [ctx.label.name]),
+        snapshots = "/".join(package_parts + ["snapshots", ctx.label.name]),
+    )
+
 def _snapshot_rule_test_impl(ctx):
-    config = _build_config(ctx)
+    blobs_dir = None
+    if ctx.attr.snapshot_store:
+        digests = _store_manifest(ctx)
+        blobs_dir = _store_blobs(ctx, digests)
+    else:
+        digests = _snapshot_digests(ctx)
+    config = _build_config(ctx, digests, blobs_dir)
     config_literal = json.encode(config)
     config_file = ctx.actions.declare_file(ctx.label.name + "_config.json")
     ctx.actions.write(config_file, config_literal + "\n")
 
-    runfiles = _gather_runfiles(ctx, extra_files = [config_file])
+    extra_files = [config_file, digests]
+    if blobs_dir:
+        extra_files.append(blobs_dir)
+    runfiles = _gather_runfiles(ctx, extra_files = extra_files)
     runner_outputs = _symlink_runner_files(ctx)
     launcher = runner_outputs.executable
 
@@ -170,6 +284,7 @@ def _snapshot_rule_test_impl(ctx):
         testing.TestEnvironment({
             "SNAPSHOT_CONFIG": "{}/{}".format(ctx.workspace_name, config_file.short_path),
         }),
+        _snapshot_test_info(ctx),
     ]
 
 _snapshot_rule_test = rule(
@@ -189,11 +304,38 @@ _snapshot_rule_test = rule(
         ),
         "data": attr.label_list(),
         "env": attr.string_dict(),
+        "jobs": attr.int(default = 0),
+        "keep_raw": attr.bool(default = True),
+        "shard_outputs": attr.bool(default = False),
+        "stream_outputs": attr.bool(default = False),
+        "fail_fast": attr.bool(default = False),
+        "max_failures": attr.int(default = 0),
+        "compress_snapshots": attr.string(
+            default = "",
+            values = ["", "gz", "zst"],
+        ),
+        "snapshot_store": attr.label(
+            providers = [SnapshotStoreInfo],
+        ),
+        "unmatched_outputs": attr.string(
+            default = "ignore",
+            values = ["ignore", "warn", "error"],
+        ),
         "_runner": attr.label(
             executable = True,
             cfg = "target",
             default = Label("//snapshot/private:runner"),
         ),
+        "_digests": attr.label(
+            executable = True,
+            cfg = "exec",
+            default = Label("//snapshot/private:digests"),
+        ),
+        "_store_blobs": attr.label(
+            executable = True,
+            cfg = "exec",
+            default = Label("//snapshot/private:store_blobs"),
+        ),
     },
 )
 
@@ -229,15 +371,84 @@ def snapshot_test(name, **kwargs):
       data: The list of files needed at runtime.
       args: Arguments passed to `test`.
       env: Environment variables passed to `test`.
+      jobs: Maximum number of output files normalized and compared concurrently.
+        Defaults to the number of available CPUs. Can be overridden at test time
+        with the `SNAPSHOT_JOBS` environment variable. Once the built-in
+        normalizers and comparators have had a fair amount of work, they move
+        to a pool of up to that many worker processes, one per CPU at most.
+      shard_count: Number of Bazel test shards. By default every shard runs
+        `test` and checks a deterministic subset of its output files.
+      shard_outputs: Set if `test` honors `TEST_TOTAL_SHARDS` and
+        `TEST_SHARD_INDEX` itself and writes only its shard's outputs. Each
+        shard then checks everything its `test` produced, and expected files
+        missing from a shard are not errors.
+      keep_raw: Whether the test's unmodified outputs are kept under `raw/` in
+        the undeclared outputs. Setting this to False halves the archived
+        size for large outputs, at the cost of losing the pre-normalization
+        files when a test fails.
+      unmatched_outputs: What to do with files `test` writes that match no
+        pattern in `outputs`: "ignore" (the default), "warn", or "error".
+      stream_outputs: Check outputs while `test` is still running. `test`
+        reports each finished output by appending its path, relative to
+        SNAPSHOT_OUTPUTS_DIR, as a line to the file named by
+        `SNAPSHOT_READY_FILE`, and must not change it afterwards. Outputs that
+        are not reported are checked after `test` exits. Ignored when shards
+        split the outputs of an unsharded `test`.
+      fail_fast: Stop checking outputs after the first failed file. Same as
+        `max_failures = 1`. Can be overridden at test time with
+        `SNAPSHOT_FAIL_FAST`.
+      max_failures: Stop checking outputs once this many files have failed; 0
+        (the default) checks every file. Files not yet started are cancelled
+        and reported as skipped, in the summary and in the JUnit report.
+        Comparators already running are left to finish, and batch
+        comparators are called for a few files at a time so that the limit
+        takes effect between calls. Can be overridden at test time with
+        `SNAPSHOT_MAX_FAILURES`. A run with skipped files never lets the
+        updater prune stale snapshots.
+      compress_snapshots: "gz" or "zst" to have the updater store snapshots
+        compressed, as `out.txt.gz` for the output `out.txt`. Compressed
+        snapshots are always read transparently, whatever this is set to, and
+        the built-in comparators decompress them while reading. zstd needs
+        Python 3.14 or the zstandard package.
+      snapshot_store: A `snapshot_store` to keep this test's snapshots in,
+        deduplicated with those of other tests. The test then has the
+        manifest `snapshots/<name>.json` instead of the directory
+        `snapshots/<name>/`; see `snapshot_store`. Cannot be combined with
+        `compress_snapshots`.
 
     Also creates a target named `{name}.update` that invokes the snapshot updater
-    for this test.
+    for this test. `bazel run {name}.update -- --accept` runs the test with
+    `SNAPSHOT_ACCEPT=1` first, which writes the normalized outputs without
+    running any comparator, so no separate `bazel test` is needed.
+
+    Setting `SNAPSHOT_CACHE_DIR` (for example with `--test_env`) enables a local
+    cache of files that passed before. A file whose raw output, normalizer and
+    comparator setup, and snapshot are all unchanged is not normalized or
+    compared again. The cache is trimmed to `SNAPSHOT_CACHE_MAX_BYTES`
+    (default 1 GiB), dropping the least recently used entries first. The
+    directory must be writable from the test sandbox.
+
+    Each run writes `profile.json` to the undeclared outputs, with the wall
+    time, CPU time, peak RSS and bytes in and out of the wrapped test and of
+    every normalizer and comparator call. Setting `SNAPSHOT_TRACE=1` also
+    writes `profile.trace.json` in Chrome trace-event format.
+
+    The JUnit report embeds at most 64 KiB of output per failure and 16 MiB
+    in total; the rest of each failure's output is in `results/<path>.log`
+    in the undeclared outputs, which the report links to. The limits can be
+    changed with `SNAPSHOT_JUNIT_MAX_FAILURE_BYTES` and
+    `SNAPSHOT_JUNIT_MAX_BYTES` (0 for no limit).
     """
-    snapshot_subdir = "snapshots/" + name
-    snapshot_files = native.glob(
-        include = [snapshot_subdir + "/**"],
-        allow_empty = True,
-    )
+    if kwargs.get("snapshot_store"):
+        snapshot_files = native.glob(
+            include = ["snapshots/{}.json".format(name)],
+            allow_empty = True,
+        )
+    else:
+        snapshot_files = native.glob(
+            include = ["snapshots/{}/**".format(name)],
+            allow_empty = True,
+        )
 
     _snapshot_rule_test(
         name = name,
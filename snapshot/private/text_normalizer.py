@@ -3,6 +3,17 @@
 
 import argparse
 import re
+import sys
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Numbered backreferences and conditionals would point at the wrong group once
+# patterns are joined into one alternation.
+_GROUP_REFERENCE = re.compile(rb"\\[1-9]|\(\?P=|\(\?\(")
+_LEADING_FLAGS = re.compile(rb"\(\?([aiLmsux]+)\)")
+# Constructs whose result can change when a line is searched as part of a
+# larger block instead of on its own.
+_BLOCK_UNSAFE = re.compile(rb"\\[AZ]|\(\?<?[=!]|\(\?>|[*+?}]\+")
 
 
 def _compile_replacements(values):
@@ -16,6 +27,69 @@ def _compile_patterns(values):
     return [re.compile(value.encode("utf-8")) for value in values]
 
 
+def _combine(patterns, flags=0):
+    """Joins compiled patterns into one regex that matches wherever any of them does.
+
+    Returns None when the patterns cannot be joined without changing their meaning.
+    """
+    parts = []
+    for pattern in patterns:
+        source = pattern.pattern
+        if _GROUP_REFERENCE.search(source):
+            return None
+        match = _LEADING_FLAGS.match(source)
+        if match:
+            source = b"(?" + match.group(1) + b":" + source[match.end():] + b")"
+        parts.append(b"(?:" + source + b")")
+    try:
+        return re.compile(b"|".join(parts), flags)
+    except re.error:
+        return None
+
+
+def _any_matcher(patterns):
+    """Returns a predicate telling whether any of `patterns` matches a line."""
+    if not patterns:
+        return None
+    combined = _combine(patterns)
+    if combined is not None:
+        return combined.search
+    return lambda content: any(p.search(content) for p in patterns)
+
+
+def _block_matcher(patterns):
+    """Returns a predicate that is false only if no pattern matches any line of a block.
+
+    Blocks must hold complete, LF-terminated lines. Returns None when that
+    guarantee cannot be given for these patterns.
+    """
+    if not patterns:
+        return lambda block: False
+    if any(_BLOCK_UNSAFE.search(p.pattern) for p in patterns):
+        return None
+    combined = _combine(patterns, re.MULTILINE)
+    if combined is None:
+        return None
+    return combined.search
+
+
+def _read_blocks(handle):
+    """Yields chunks of complete lines, then any unterminated final line."""
+    remainder = b""
+    while True:
+        chunk = handle.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        if remainder:
+            chunk = remainder + chunk
+        end = chunk.rfind(b"\n") + 1
+        remainder = chunk[end:]
+        if end:
+            yield chunk[:end]
+    if remainder:
+        yield remainder
+
+
 def _split_line(line):
     if line.endswith(b"\r\n"):
         return line[:-2], b"\r\n"
@@ -23,7 +97,62 @@ def _split_line(line):
         return line[:-1], line[-1:]
     return line, b""
 
-def main():
+def normalize_stream(infile, outfile, replace_patterns, include_patterns, exclude_patterns, newline):
+    """Copies `infile` to `outfile`, applying the line transforms.
+
+    Each line is transformed as if the replacements were applied one after the
+    other and then filtered, but lines no pattern can touch are detected with a
+    single combined search, and whole blocks of them are copied at once.
+    """
+    needs_replace = _any_matcher([pattern for pattern, _ in replace_patterns])
+    included = _any_matcher(include_patterns)
+    excluded = _any_matcher(exclude_patterns)
+    untouched_block = None
+    if not include_patterns:
+        untouched_block = _block_matcher([pattern for pattern, _ in replace_patterns] + exclude_patterns)
+
+    for block in _read_blocks(infile):
+        if not block.endswith(b"\n"):
+            content, ending = _split_line(block)
+            line = _transform_line(content, replace_patterns, needs_replace, included, excluded)
+            if line is not None:
+                outfile.write(line + (ending if newline is None else newline))
+            continue
+        if untouched_block is not None and b"\r" not in block and not untouched_block(block):
+            outfile.write(_convert_newlines(block, newline))
+            continue
+        output = []
+        for piece in block.split(b"\n")[:-1]:
+            if piece.endswith(b"\r"):
+                content, ending = piece[:-1], b"\r\n"
+            else:
+                content, ending = piece, b"\n"
+            line = _transform_line(content, replace_patterns, needs_replace, included, excluded)
+            if line is not None:
+                output.append(line + (ending if newline is None else newline))
+        outfile.write(b"".join(output))
+
+
+def _transform_line(content, replace_patterns, needs_replace, included, excluded):
+    if needs_replace and needs_replace(content):
+        for pattern, replacement in replace_patterns:
+            content = pattern.sub(replacement, content)
+    if included and not included(content):
+        return None
+    if excluded and excluded(content):
+        return None
+    return content
+
+
+def _convert_newlines(block, newline):
+    """Rewrites the line endings of a block of LF-terminated lines without a CR."""
+    if newline is None or newline == b"\n":
+        return block
+    return block.replace(b"\n", newline)
+
+
+def run(argv, stdout, stderr):
+    """Normalize the file named in `argv`; returns the exit code."""
     parser = argparse.ArgumentParser(description="Normalize snapshot text outputs.")
     parser.add_argument("input_path")
     parser.add_argument("output_path")
@@ -53,7 +182,7 @@ def main():
         default="none",
         help="Normalize line endings.",
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.line_ending == "unix":
         replacement_newline = b"\n"
@@ -67,17 +196,19 @@ def main():
     exclude_patterns = _compile_patterns(args.exclude_line)
 
     with open(args.input_path, "rb") as infile, open(args.output_path, "wb") as outfile:
-        for line in infile:
-            content, newline = _split_line(line)
-            for pattern, replacement in replace_patterns:
-                content = pattern.sub(replacement, content)
-            if include_patterns and not any(p.search(content) for p in include_patterns):
-                continue
-            if exclude_patterns and any(p.search(content) for p in exclude_patterns):
-                continue
-            if replacement_newline is not None:
-                newline = replacement_newline
-            outfile.write(content + newline)
+        normalize_stream(
+            infile,
+            outfile,
+            replace_patterns,
+            include_patterns,
+            exclude_patterns,
+            replacement_newline,
+        )
+    return 0
+
+
+def main():
+    sys.exit(run(sys.argv[1:], sys.stdout, sys.stderr))
 
 
 if __name__ == "__main__":
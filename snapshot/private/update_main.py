@@ -1,31 +1,193 @@
 #!/usr/bin/env python3
 """Updates snapshot files from the latest test outputs."""
 
+import collections
+import concurrent.futures
+import functools
+import json
 import os
+import re
 import shutil
 import stat
 import subprocess
 import sys
+import tempfile
+
+from compare import compressed
+from python.runfiles import runfiles
+from snapshot.private import digests
+from snapshot.private import fileops
+
+
+_SHARD_DIR = re.compile(r"^shard_\d+_of_(\d+)$")
+_STATUSES = ["added", "changed", "removed", "unchanged"]
 
 
 def main():
     workspace = os.environ["BUILD_WORKSPACE_DIRECTORY"]
 
     args = sys.argv[1:]
-    labels = _resolve_labels(workspace, args)
+    accept = _resolve_accept()
+    if "--accept" in args:
+        accept = True
+        args = [arg for arg in args if arg != "--accept"]
+    targets = _resolve_targets(workspace, args)
+    labels = [label for label, _ in targets]
+    if accept:
+        _run_accept(workspace, labels)
 
     failures = []
-    for label in labels:
-        try:
-            _update_target(workspace, label)
-        except RuntimeError as exc:
-            print(str(exc), file=sys.stderr)
-            failures.append(label)
+    totals = collections.Counter()
+    updated = 0
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        pending = []
+        for label, paths in targets:
+            try:
+                update = _update_target(workspace, label, paths, executor)
+            except RuntimeError as exc:
+                print(str(exc), file=sys.stderr)
+                failures.append(label)
+                continue
+            except Exception as exc:  # pylint: disable=broad-except
+                print("Failed to update {}: {}".format(label, exc), file=sys.stderr)
+                failures.append(label)
+                continue
+            if update:
+                pending.append((label,) + update)
+        for label, futures, finish in pending:
+            try:
+                counts = finish([future.result() for future in futures])
+            except Exception as exc:  # pylint: disable=broad-except
+                print("Failed to update {}: {}".format(label, exc), file=sys.stderr)
+                failures.append(label)
+                continue
+            totals.update(counts)
+            updated += 1
+            print("{}: {}".format(label, _format_counts(counts)))
 
+    if len(labels) > 1:
+        print("Updated {} targets: {}".format(updated, _format_counts(totals)))
     if failures:
         sys.exit("Failed to update: {}".format(", ".join(failures)))
 
 
+def _resolve_accept():
+    return os.environ.get("SNAPSHOT_UPDATE_ACCEPT", "").lower() not in ("", "0", "false", "no")
+
+
+def _run_accept(workspace, labels):
+    """Runs the tests in accept mode so their normalized outputs are fresh.
+
+    The runner skips every comparator and passes as long as the wrapped test
+    and normalizers succeed, so a single pass is enough to update snapshots.
+    """
+    labels = [_normalize_label(label) for label in labels]
+    print("Accepting outputs of {} targets".format(len(labels)))
+    result = subprocess.run(
+        ["bazel", "test", "--test_env=SNAPSHOT_ACCEPT=1", "--"] + labels,
+        cwd=workspace,
+        check=False,
+    )
+    if result.returncode != 0:
+        sys.exit("bazel test in accept mode failed with exit code {}".format(result.returncode))
+
+
+def _format_counts(counts):
+    return ", ".join("{} {}".format(counts[status], status) for status in _STATUSES)
+
+
+def _resolve_targets(workspace, args):
+    """Returns (label, paths) pairs for the targets to update.
+
+    `paths` is the (testlogs, snapshots) pair recorded in the build-time
+    manifest, or None if the label is not in it. The manifest replaces the
+    pattern query when it lists every snapshot test of its packages.
+    """
+    manifest = _load_manifest()
+    if manifest is None:
+        return [(label, None) for label in _resolve_labels(workspace, args)]
+    known = {}
+    for entry in manifest.get("targets", []):
+        known[_normalize_label(entry["label"])] = (entry["testlogs"], entry["snapshots"])
+    patterns = manifest.get("patterns")
+    packages = manifest.get("packages")
+    # Recursive patterns record no packages, so only the query can find their tests.
+    if patterns and packages:
+        if _manifest_is_complete(workspace, packages, known):
+            if not known:
+                sys.exit("No snapshot_test targets matched")
+            return list(known.items())
+        print("Target manifest is incomplete; querying {}".format(" ".join(patterns)), file=sys.stderr)
+    labels = _resolve_labels(workspace, args)
+    return [(label, known.get(_normalize_label(label))) for label in labels]
+
+
+def _load_manifest():
+    path = os.environ.get("SNAPSHOT_UPDATE_MANIFEST")
+    if not path:
+        return None
+    runfiles_ctx = runfiles.Create()
+    resolved = runfiles_ctx.Rlocation(path) if runfiles_ctx else None
+    if not resolved:
+        return None
+    try:
+        with open(resolved, "r", encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def _manifest_is_complete(workspace, packages, known):
+    """Checks that no test in `packages` left runner outputs without being in `known`.
+
+    A test that never ran has nothing to update, so testlogs are enough to
+    spot snapshot tests declared after the manifest was recorded.
+    """
+    known_testlogs = {testlogs for testlogs, _ in known.values()}
+    testlogs_root = os.path.join(workspace, "bazel-testlogs")
+    for package in packages:
+        for testlogs in _tests_with_outputs(workspace, testlogs_root, package):
+            if testlogs not in known_testlogs:
+                return False
+    return True
+
+
+def _tests_with_outputs(workspace, testlogs_root, package):
+    """Yields testlogs paths, like "pkg/name", of tests in `package` that wrote runner outputs."""
+    pending = [package]
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            entries = os.listdir(os.path.join(testlogs_root, rel_dir))
+        except OSError:
+            continue
+        if "test.outputs" in entries or any(_SHARD_DIR.match(entry) for entry in entries):
+            if _has_runner_outputs(os.path.join(testlogs_root, rel_dir), entries):
+                yield rel_dir
+            continue
+        for entry in entries:
+            child = rel_dir + "/" + entry if rel_dir else entry
+            if not rel_dir and entry == "external":
+                continue
+            if _is_package(workspace, child) or not os.path.isdir(os.path.join(testlogs_root, child)):
+                continue
+            pending.append(child)
+
+
+def _has_runner_outputs(test_dir, entries):
+    candidates = ["test.outputs"]
+    candidates.extend(os.path.join(entry, "test.outputs") for entry in entries if _SHARD_DIR.match(entry))
+    return any(
+        os.path.exists(os.path.join(test_dir, candidate, "snapshot_outputs.json"))
+        for candidate in candidates
+    )
+
+
+def _is_package(workspace, rel_dir):
+    package_dir = os.path.join(workspace, rel_dir)
+    return any(os.path.isfile(os.path.join(package_dir, build)) for build in ("BUILD.bazel", "BUILD"))
+
+
 def _resolve_labels(workspace, args):
     labels_env = os.environ.get("SNAPSHOT_UPDATE_LABELS")
     if labels_env:
@@ -61,58 +223,333 @@ def _resolve_snapshot_labels(workspace, patterns):
     return labels
 
 
-def _update_target(workspace, label):
+def _update_target(workspace, label, paths, executor):
+    """Schedules the snapshot updates for `label`.
+
+    `paths` is the (testlogs, snapshots) pair from the target manifest, or
+    None to derive both from the label. Returns (futures, finish), where
+    `finish` turns the results of the futures into counts of the statuses
+    in _STATUSES, or None if the target was skipped.
+    """
     label = _normalize_label(label)
     if label.startswith("@"):
         raise RuntimeError("External target not supported: {}".format(label))
     if not label.startswith("//"):
         raise RuntimeError("Invalid label: {}".format(label))
+    if paths is None:
+        paths = _label_paths(label)
+    testlogs, snapshots = paths
+
+    source_dirs = _resolve_source_dirs(workspace, testlogs)
+    if not source_dirs:
+        print("Skipping {}: test outputs not available; run the test first".format(label), file=sys.stderr)
+        return None
+
+    codec = _output_compression(source_dirs)
+    if codec == "zst" and not compressed.zstd_available():
+        raise RuntimeError("Cannot update {}: zstd snapshots need Python 3.14 or the zstandard package".format(label))
+
+    store = _output_store(source_dirs)
+    if store:
+        store_dir = os.path.join(workspace, store)
+        futures = _store_snapshot_outputs(executor, source_dirs, store_dir)
+        finish = functools.partial(
+            _write_store_manifest,
+            os.path.join(workspace, snapshots + ".json"),
+            _complete_outputs(source_dirs),
+        )
+    else:
+        dest_dir = os.path.join(workspace, snapshots)
+        os.makedirs(dest_dir, exist_ok=True)
+        futures = _copy_snapshot_outputs(executor, source_dirs, dest_dir, codec)
+        finish = functools.partial(_count_statuses, dest_dir)
+    if not futures:
+        print("Skipping {}: no outputs found under {}".format(label, ", ".join(source_dirs)), file=sys.stderr)
+        return None
+    return futures, finish
+
+
+def _label_paths(label):
+    """Derives the (testlogs, snapshots) paths of a label without the manifest."""
     package, name = _parse_label(label)
     if not name:
         raise RuntimeError("Invalid label: {}".format(label))
+    prefix = package + "/" if package else ""
+    return prefix + name, prefix + "snapshots/" + name
 
-    source_dir = _resolve_source_dir(workspace, package, name)
-    if not os.path.isdir(source_dir):
-        print("Skipping {}: test outputs not available; run the test first".format(label), file=sys.stderr)
-        return
 
-    dest_dir = _resolve_destination_dir(workspace, package, name)
-    os.makedirs(dest_dir, exist_ok=True)
+def _resolve_source_dirs(workspace, testlogs):
+    """Returns the normalized output directories of a test's last run, one per shard.
 
-    copied = _copy_snapshot_outputs(source_dir, dest_dir)
-    if copied == 0:
-        print("Skipping {}: no outputs found under {}".format(label, source_dir), file=sys.stderr)
-        return
-    print(label)
+    Bazel leaves the outputs of earlier runs with a different shard count,
+    or without sharding, in place, so only the layout written last is used.
+    """
+    testlogs_dir = os.path.join(workspace, "bazel-testlogs", testlogs)
+    candidates = [(1, os.path.join(testlogs_dir, "test.outputs", "normalized"))]
+    if os.path.isdir(testlogs_dir):
+        for entry in sorted(os.listdir(testlogs_dir)):
+            match = _SHARD_DIR.match(entry)
+            if match:
+                path = os.path.join(testlogs_dir, entry, "test.outputs", "normalized")
+                candidates.append((int(match.group(1)), path))
+    layouts = {}
+    for total, path in candidates:
+        if os.path.isdir(path):
+            layouts.setdefault(total, []).append(path)
+    if not layouts:
+        return []
+    return max(layouts.values(), key=lambda paths: max(_run_time(path) for path in paths))
+
+
+def _run_time(source_dir):
+    """Returns when the run that wrote a normalized directory finished."""
+    manifest = os.path.join(os.path.dirname(source_dir), "snapshot_outputs.json")
+    return os.path.getmtime(manifest if os.path.exists(manifest) else source_dir)
+
+
+def _normalized_sources(source_dirs):
+    """Maps the relative path of every normalized output to its file."""
+    sources = {}
+    for source_dir in source_dirs:
+        for root, _, files in os.walk(source_dir):
+            for filename in files:
+                src = os.path.join(root, filename)
+                sources[os.path.relpath(src, source_dir)] = src
+    return sources
+
+
+def _copy_snapshot_outputs(executor, source_dirs, dest_dir, codec=None):
+    """Submits a sync for every normalized output, plus removal of stale snapshots."""
+    sources = _normalized_sources(source_dirs)
+    produced = set(sources)
+    futures = [
+        executor.submit(_sync_file, src, dest_dir, rel, codec, produced)
+        for rel, src in sources.items()
+    ]
+    if not futures:
+        return futures
+    expected = _complete_outputs(source_dirs)
+    if expected is not None:
+        for rel in _existing_snapshots(dest_dir):
+            if rel in expected or rel in produced:
+                continue
+            # The compressed form of a current output is handled by its sync.
+            stored_codec = compressed.codec_of(rel)
+            if stored_codec:
+                logical = rel[:-len(compressed.suffix_of(stored_codec))]
+                if logical in expected or logical in produced:
+                    continue
+            futures.append(executor.submit(_remove_file, os.path.join(dest_dir, rel)))
+    return futures
+
+
+def _load_output_manifest(source_dir):
+    """Returns the snapshot_outputs.json the runner wrote next to a normalized directory, or None."""
+    path = os.path.join(os.path.dirname(source_dir), "snapshot_outputs.json")
+    try:
+        with open(path, "r", encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def _output_compression(source_dirs):
+    """Returns the codec the test asks snapshots to be stored with, or None."""
+    for source_dir in source_dirs:
+        manifest = _load_output_manifest(source_dir)
+        if manifest and manifest.get("compression"):
+            return manifest["compression"]
+    return None
+
+
+def _output_store(source_dirs):
+    """Returns the snapshot store the test keeps its snapshots in, relative to the workspace, or None."""
+    for source_dir in source_dirs:
+        manifest = _load_output_manifest(source_dir)
+        if manifest and manifest.get("store"):
+            return manifest["store"]
+    return None
+
+
+def _count_statuses(dest_dir, statuses):
+    counts = collections.Counter(statuses)
+    if counts["removed"]:
+        _prune_empty_dirs(dest_dir)
+    return counts
+
+
+def _store_snapshot_outputs(executor, source_dirs, store_dir):
+    """Submits adding every normalized output to the store; each future yields (rel, digest)."""
+    return [
+        executor.submit(_store_blob, src, store_dir, rel)
+        for rel, src in _normalized_sources(source_dirs).items()
+    ]
+
+
+def _store_blob(src, store_dir, rel):
+    """Copies `src` into the store unless a blob with its content is already there."""
+    digest = {"size": os.path.getsize(src), "sha256": digests.file_sha256(src)}
+    dst = os.path.join(store_dir, digests.blob_path(digest["sha256"]))
+    if not os.path.isfile(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(prefix=".snapshot_", dir=os.path.dirname(dst))
+        os.close(handle)
+        try:
+            fileops.copy_file(src, tmp_path)
+            _set_snapshot_mode(tmp_path)
+            # Other targets may add the same blob concurrently; a rename never exposes a partial file.
+            os.replace(tmp_path, dst)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return rel.replace(os.sep, "/"), digest
 
 
-def _resolve_source_dir(workspace, package, name):
-    testlogs_dir = os.path.join(workspace, "bazel-testlogs")
-    if package:
-        testlogs_dir = os.path.join(testlogs_dir, package)
-    testlogs_dir = os.path.join(testlogs_dir, name, "test.outputs")
-    return os.path.join(testlogs_dir, "normalized")
+def _write_store_manifest(manifest_path, expected, stored):
+    """Points the test's store manifest at the blobs in `stored`; returns the status counts.
 
+    Entries of outputs the last run did not produce are dropped only when
+    that run was complete, as stale snapshot files are in a directory.
+    """
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as handle:
+            previous = json.load(handle)
+    except FileNotFoundError:
+        previous = {}
+    except ValueError:
+        raise OSError("invalid snapshot manifest {}".format(manifest_path))
+    entries = dict(stored)
+    if expected is None:
+        for rel, digest in previous.items():
+            entries.setdefault(rel, digest)
+    counts = collections.Counter()
+    for rel, digest in entries.items():
+        if rel not in previous:
+            counts["added"] += 1
+        elif previous[rel] != digest:
+            counts["changed"] += 1
+        else:
+            counts["unchanged"] += 1
+    counts["removed"] = len(set(previous) - set(entries))
+    if entries != previous:
+        os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(prefix=".snapshot_", dir=os.path.dirname(manifest_path))
+        try:
+            with os.fdopen(handle, "w", encoding="utf-8") as output:
+                json.dump(entries, output, indent=2, sort_keys=True)
+                output.write("\n")
+            _set_snapshot_mode(tmp_path)
+            os.replace(tmp_path, manifest_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return counts
 
-def _resolve_destination_dir(workspace, package, name):
-    dest_root = os.path.join(workspace, package) if package else workspace
-    return os.path.join(dest_root, "snapshots", name)
 
+def _complete_outputs(source_dirs):
+    """Returns every output path of the last test run, or None if it may be partial.
 
-def _copy_snapshot_outputs(source_dir, dest_dir):
-    copied = 0
-    for root, _, files in os.walk(source_dir):
+    Relies on the snapshot_outputs.json the runner writes next to each
+    normalized directory. Stale snapshots are only pruned when every shard
+    is present and none of them had a normalizer failure.
+    """
+    outputs = set()
+    shards = set()
+    for source_dir in source_dirs:
+        manifest = _load_output_manifest(source_dir)
+        if manifest is None or not manifest.get("complete"):
+            return None
+        shards.add(tuple(manifest.get("shard") or (0, 1)))
+        outputs.update(rel.replace("/", os.sep) for rel in manifest.get("outputs", []))
+    totals = {total for _, total in shards}
+    if len(totals) != 1 or len(shards) != totals.pop():
+        return None
+    return outputs
+
+
+def _existing_snapshots(dest_dir):
+    for root, _, files in os.walk(dest_dir):
         for filename in files:
-            src = os.path.join(root, filename)
-            rel = os.path.relpath(src, source_dir)
-            dst = os.path.join(dest_dir, rel)
-            parent = os.path.dirname(dst)
-            if parent:
-                os.makedirs(parent, exist_ok=True)
-            shutil.copyfile(src, dst)
-            _set_snapshot_mode(dst)
-            copied += 1
-    return copied
+            yield os.path.relpath(os.path.join(root, filename), dest_dir)
+
+
+def _sync_file(src, dest_dir, rel, codec, produced):
+    """Writes the snapshot of output `rel`, compressed with `codec` unless it is None.
+
+    Without a codec, an existing snapshot keeps the form it is stored in.
+    Any other stored form of the same output is removed.
+    """
+    forms = _stored_forms(dest_dir, rel, produced)
+    if codec:
+        dst = os.path.join(dest_dir, rel + compressed.suffix_of(codec))
+    elif forms:
+        dst = forms[0]
+    else:
+        dst = os.path.join(dest_dir, rel)
+    if dst in forms and _same_content(src, dst, dst != os.path.join(dest_dir, rel)):
+        status = "unchanged"
+    else:
+        status = "changed" if forms else "added"
+        parent = os.path.dirname(dst)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        if dst == os.path.join(dest_dir, rel):
+            fileops.copy_file(src, dst)
+        else:
+            _write_compressed(src, dst)
+    _set_snapshot_mode(dst)
+    for path in forms:
+        if path != dst:
+            os.remove(path)
+            status = "changed"
+    return status
+
+
+def _stored_forms(dest_dir, rel, produced):
+    """Returns the existing snapshot files of output `rel`, uncompressed first."""
+    candidates = [rel]
+    candidates.extend(rel + suffix for suffix in compressed.SUFFIXES if rel + suffix not in produced)
+    return [
+        os.path.join(dest_dir, candidate)
+        for candidate in candidates
+        if os.path.isfile(os.path.join(dest_dir, candidate))
+    ]
+
+
+def _same_content(src, dst, decompress):
+    if not decompress and os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    try:
+        return digests.file_sha256(src) == digests.file_sha256(dst, decompress)
+    except Exception:  # pylint: disable=broad-except
+        # An unreadable compressed snapshot is simply rewritten.
+        return False
+
+
+def _write_compressed(src, dst):
+    handle, tmp_path = tempfile.mkstemp(prefix=".snapshot_", dir=os.path.dirname(dst))
+    os.close(handle)
+    try:
+        with open(src, "rb") as source, compressed.open_write(tmp_path, compressed.codec_of(dst)) as output:
+            shutil.copyfileobj(source, output, 1024 * 1024)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _remove_file(path):
+    os.remove(path)
+    return "removed"
+
+
+def _prune_empty_dirs(dest_dir):
+    for root, dirs, files in os.walk(dest_dir, topdown=False):
+        if root != dest_dir and not dirs and not files:
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
 
 
 def _parse_label(label):
@@ -1,3 +1,20 @@
+SnapshotTestInfo = provider(
+    doc = "Where the updater finds the outputs of a snapshot test and where its snapshots live.",
+    fields = {
+        "label": "The label of the test.",
+        "testlogs": "Directory of the test under bazel-testlogs, relative to it.",
+        "snapshots": "Snapshot directory, relative to the workspace root.",
+    },
+)
+
+def _manifest_entry(target):
+    info = target[SnapshotTestInfo]
+    return {
+        "label": str(info.label),
+        "testlogs": info.testlogs,
+        "snapshots": info.snapshots,
+    }
+
 def _snapshot_update_impl(ctx):
     launcher = ctx.actions.declare_file(ctx.label.name)
     ctx.actions.symlink(
@@ -6,14 +23,27 @@ def _snapshot_update_impl(ctx):
         is_executable = True,
     )
 
-    runfiles = ctx.runfiles(files = [ctx.executable._updater])
+    # Resolving labels and paths at build time spares the updater a
+    # `bazel query` whenever the manifest is known to be complete.
+    manifest = ctx.actions.declare_file(ctx.label.name + ".targets.json")
+    ctx.actions.write(manifest, json.encode({
+        "targets": [_manifest_entry(target) for target in ctx.attr.labels + ctx.attr.discovered],
+        "patterns": ctx.attr.patterns,
+        "packages": ctx.attr.discovered_packages,
+    }) + "\n")
+
+    runfiles = ctx.runfiles(files = [ctx.executable._updater, manifest])
     runfiles = runfiles.merge(ctx.attr._updater[DefaultInfo].default_runfiles)
 
-    env = {}
+    env = {
+        "SNAPSHOT_UPDATE_MANIFEST": "{}/{}".format(ctx.workspace_name, manifest.short_path),
+    }
     if ctx.attr.labels:
         env["SNAPSHOT_UPDATE_LABELS"] = "\n".join([str(target.label) for target in ctx.attr.labels])
     if ctx.attr.patterns:
         env["SNAPSHOT_UPDATE_PATTERNS"] = "\n".join(ctx.attr.patterns)
+    if ctx.attr.accept:
+        env["SNAPSHOT_UPDATE_ACCEPT"] = "1"
 
     return [
         DefaultInfo(executable = launcher, runfiles = runfiles),
@@ -25,8 +55,25 @@ snapshot_update_rule = rule(
     implementation = _snapshot_update_impl,
     executable = True,
     attrs = {
-        "labels": attr.label_list(),
+        "accept": attr.bool(
+            default = False,
+            doc = "Run the tests with SNAPSHOT_ACCEPT=1 before copying, instead of " +
+                  "requiring a prior `bazel test`. Comparators are skipped in that run. " +
+                  "Also available as `bazel run <target> -- --accept`.",
+        ),
+        "labels": attr.label_list(
+            providers = [SnapshotTestInfo],
+        ),
         "patterns": attr.string_list(),
+        "discovered": attr.label_list(
+            providers = [SnapshotTestInfo],
+            doc = "Snapshot tests known at load time to match `patterns`. The updater " +
+                  "uses them instead of querying the patterns unless `discovered_packages` " +
+                  "holds test outputs of a test missing from this list.",
+        ),
+        "discovered_packages": attr.string_list(
+            doc = "Packages whose snapshot tests are all listed in `discovered`.",
+        ),
         "_updater": attr.label(
             executable = True,
             cfg = "target",
@@ -1,28 +1,61 @@
 load("//snapshot/private:update_rule.bzl", "snapshot_update_rule")
 
 
-def snapshot_update_target(name, visibility = None):
+def snapshot_update_target(name, visibility = None, accept = False):
     snapshot_update_rule(
         name = name,
+        accept = accept,
         visibility = visibility,
     )
 
 
-def update_all(name, visibility = None, testonly = True, recursive = False):
+def update_all(name, visibility = None, testonly = True, recursive = False, accept = False, targets = None):
     """Create a script that updates snapshot tests in this package.
 
+    Snapshot tests declared above `update_all` in the same BUILD file are
+    recorded at build time, so the updater does not need `bazel query` to
+    find them. It falls back to the query when the package has test outputs
+    of a snapshot test missing from that record, such as one declared below
+    `update_all`. Recursive patterns always use the query unless `targets`
+    is given.
+
     Args:
       recursive: If True, also update snapshot tests in subpackages.
+      accept: If True, run the tests in accept mode first, so no separate
+        `bazel test` is needed and comparators are skipped.
+      targets: Snapshot tests to update instead of matching the package
+        pattern. Their labels and paths come from the build, never a query.
     """
+    if targets != None:
+        snapshot_update_rule(
+            name = name,
+            labels = targets,
+            accept = accept,
+            testonly = testonly,
+            visibility = visibility,
+        )
+        return
+
     package = native.package_name()
     if recursive:
         pattern = "//{}...".format(package + "/" if package else "")
+        discovered = []
+        discovered_packages = []
     else:
         pattern = "//{}:*".format(package) if package else "//:*"
+        discovered = [
+            ":" + rule["name"]
+            for rule in native.existing_rules().values()
+            if rule["kind"] == "_snapshot_rule_test"
+        ]
+        discovered_packages = [package]
 
     snapshot_update_rule(
         name = name,
         patterns = [pattern],
+        discovered = discovered,
+        discovered_packages = discovered_packages,
+        accept = accept,
         testonly = testonly,
         visibility = visibility,
     )
@@ -15,12 +15,23 @@ load(
     _json_normalizer = "json_normalizer",
     _text_normalizer = "text_normalizer",
 )
+load(
+    "//snapshot:comparators.bzl",
+    _binary_comparator = "binary_comparator",
+    _json_comparator = "json_comparator",
+    _text_comparator = "text_comparator",
+)
+load("//snapshot/private:store_rule.bzl", _snapshot_store = "snapshot_store")
 load("//snapshot/private:update_target.bzl", _update_all = "update_all")
 
 snapshot_format = _snapshot_format
 snapshot_normalizer = _snapshot_normalizer
 snapshot_comparator = _snapshot_comparator
 snapshot_test = _snapshot_test
+snapshot_store = _snapshot_store
 update_all = _update_all
 text_normalizer = _text_normalizer
 json_normalizer = _json_normalizer
+text_comparator = _text_comparator
+json_comparator = _json_comparator
+binary_comparator = _binary_comparator